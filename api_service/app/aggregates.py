@@ -0,0 +1,210 @@
+"""
+Файл содержит статистику по test_items.value, вычисляемую в БД одним
+запросом: количество, минимум, максимум, среднее, процентили и
+гистограмма, при необходимости — по префиксам названий.
+
+Источником служат либо сами строки (с фильтрами списка элементов),
+либо сводка item_value_summary (значение -> число элементов), которую
+триггеры обновляют при каждой вставке, изменении и удалении.
+"""
+
+from sqlalchemy import select, func, literal, case, String, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import TestTable, ItemValueSummary
+from . import crud
+
+# Процентили в ответе (целые проценты: ранги считаются целочисленным делением)
+PERCENTILES = (50, 90, 95, 99)
+
+_ADD_ROWS = """
+    INSERT INTO item_value_summary (value, item_count)
+    SELECT value, count(*) FROM new_rows WHERE value IS NOT NULL GROUP BY value
+    ON CONFLICT (value) DO UPDATE SET item_count = item_value_summary.item_count + EXCLUDED.item_count;
+"""
+
+_REMOVE_ROWS = """
+    UPDATE item_value_summary AS summary SET item_count = summary.item_count - removed.item_count
+    FROM (SELECT value, count(*) AS item_count FROM old_rows WHERE value IS NOT NULL GROUP BY value) AS removed
+    WHERE summary.value = removed.value;
+"""
+
+
+def _pg_function(name: str, body: str) -> str:
+    return f"""
+        CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            {body}
+            RETURN NULL;
+        END $$
+    """
+
+
+# DDL триггеров, поддерживающих сводку; для других диалектов сводка недоступна.
+# PostgreSQL: триггеры уровня оператора с таблицами переходов — пакетная
+# вставка обновляет сводку одним INSERT ... GROUP BY, а не построчно.
+SUMMARY_TRIGGERS = {
+    "postgresql": [
+        _pg_function("item_value_summary_insert", _ADD_ROWS),
+        _pg_function("item_value_summary_delete", _REMOVE_ROWS),
+        _pg_function("item_value_summary_update", _REMOVE_ROWS + _ADD_ROWS),
+        "DROP TRIGGER IF EXISTS test_items_summary_insert ON test_items",
+        "DROP TRIGGER IF EXISTS test_items_summary_delete ON test_items",
+        "DROP TRIGGER IF EXISTS test_items_summary_update ON test_items",
+        """CREATE TRIGGER test_items_summary_insert AFTER INSERT ON test_items
+           REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION item_value_summary_insert()""",
+        """CREATE TRIGGER test_items_summary_delete AFTER DELETE ON test_items
+           REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION item_value_summary_delete()""",
+        """CREATE TRIGGER test_items_summary_update AFTER UPDATE ON test_items
+           REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+           FOR EACH STATEMENT EXECUTE FUNCTION item_value_summary_update()""",
+    ],
+    "sqlite": [
+        """CREATE TRIGGER IF NOT EXISTS test_items_summary_insert AFTER INSERT ON test_items
+           WHEN NEW.value IS NOT NULL BEGIN
+               INSERT INTO item_value_summary (value, item_count) VALUES (NEW.value, 1)
+               ON CONFLICT (value) DO UPDATE SET item_count = item_count + 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS test_items_summary_delete AFTER DELETE ON test_items
+           WHEN OLD.value IS NOT NULL BEGIN
+               UPDATE item_value_summary SET item_count = item_count - 1 WHERE value = OLD.value;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS test_items_summary_update AFTER UPDATE OF value ON test_items
+           WHEN OLD.value IS NOT NEW.value BEGIN
+               UPDATE item_value_summary SET item_count = item_count - 1 WHERE value = OLD.value;
+               INSERT INTO item_value_summary (value, item_count) SELECT NEW.value, 1 WHERE NEW.value IS NOT NULL
+               ON CONFLICT (value) DO UPDATE SET item_count = item_count + 1;
+           END""",
+    ],
+}
+
+# Пересчет сводки по текущим строкам (при создании)
+SUMMARY_BACKFILL = """
+    INSERT INTO item_value_summary (value, item_count)
+    SELECT value, count(*) FROM test_items WHERE value IS NOT NULL GROUP BY value
+"""
+
+
+def summary_available(db: AsyncSession) -> bool:
+    """Поддерживается ли сводка диалектом текущего подключения"""
+    return db.get_bind().dialect.name in SUMMARY_TRIGGERS
+
+
+def _live_values(db: AsyncSession, prefix_length: int = None, **filters):
+    """Строки (группа, значение, вес 1) с фильтрами списка элементов"""
+    group = func.substr(TestTable.name, 1, prefix_length) if prefix_length else literal("", String)
+    query = crud.test_items_query(db, **filters).order_by(None)
+    return query.with_only_columns(
+        group.label("grp"), TestTable.value.label("value"), literal(1, Integer).label("weight")
+    ).filter(TestTable.value.isnot(None)).subquery()
+
+
+def _summary_values(value_min: int = None, value_max: int = None):
+    """Строки сводки (группа "", значение, число элементов)"""
+    query = select(
+        literal("", String).label("grp"), ItemValueSummary.value.label("value"),
+        ItemValueSummary.item_count.label("weight"),
+    ).filter(ItemValueSummary.item_count > 0)
+    if value_min is not None:
+        query = query.filter(ItemValueSummary.value >= value_min)
+    if value_max is not None:
+        query = query.filter(ItemValueSummary.value <= value_max)
+    return query.subquery()
+
+
+def stats_query(values, bins: int):
+    """Один запрос по взвешенным значениям: агрегаты групп, соединенные с корзинами гистограммы.
+
+    Ранжированные строки вынесены в CTE, чтобы оконные функции
+    вычислялись один раз для обеих частей запроса.
+
+    Процентили считаются по накопленному весу: для каждого процентиля
+    возвращаются значения на двух соседних рангах, интерполяция
+    (как у percentile_cont) выполняется в summarize().
+    """
+    ranked = select(
+        values.c.grp, values.c.value, values.c.weight,
+        func.sum(values.c.weight).over(partition_by=values.c.grp, order_by=values.c.value).label("cumulative"),
+        func.sum(values.c.weight).over(partition_by=values.c.grp).label("total"),
+        func.min(values.c.value).over().label("low"),
+        func.max(values.c.value).over().label("high"),
+    ).cte("ranked")
+
+    percentile_columns = []
+    for percent in PERCENTILES:
+        # Целочисленный ранг 1 + floor(p * (n - 1)) одинаково вычисляется в PostgreSQL и SQLite
+        rank = 1 + (ranked.c.total - 1) * percent // 100
+        percentile_columns += [
+            func.min(case((ranked.c.cumulative >= rank, ranked.c.value))).label(f"p{percent}_low"),
+            func.min(case((ranked.c.cumulative >= rank + 1, ranked.c.value))).label(f"p{percent}_high"),
+        ]
+    groups = (
+        select(
+            ranked.c.grp,
+            func.sum(ranked.c.weight).label("count"),
+            func.min(ranked.c.value).label("min"),
+            func.max(ranked.c.value).label("max"),
+            func.sum(ranked.c.value * ranked.c.weight).label("sum"),
+            func.min(ranked.c.low).label("low"),
+            func.min(ranked.c.high).label("high"),
+            *percentile_columns,
+        )
+        .group_by(ranked.c.grp)
+        .subquery()
+    )
+
+    # Границы корзин общие для всех групп: [low, high] делится на bins равных частей
+    bucket = ((ranked.c.value - ranked.c.low) * bins // (ranked.c.high - ranked.c.low + 1)).label("bucket")
+    buckets = (
+        select(ranked.c.grp, bucket, func.sum(ranked.c.weight).label("bucket_count"))
+        .group_by(ranked.c.grp, bucket)
+        .subquery()
+    )
+    return (
+        select(groups, buckets.c.bucket, buckets.c.bucket_count)
+        .join(buckets, buckets.c.grp == groups.c.grp)
+        .order_by(groups.c.grp, buckets.c.bucket)
+    )
+
+
+def _percentile(row, percent: int) -> float:
+    """Линейная интерполяция между соседними рангами"""
+    position = percent / 100 * (row.count - 1)
+    fraction = position - int(position)
+    low, high = getattr(row, f"p{percent}_low"), getattr(row, f"p{percent}_high")
+    if high is None or fraction == 0:
+        return float(low)
+    return low + (high - low) * fraction
+
+
+def summarize(rows, bins: int, grouped: bool) -> list[dict]:
+    """Собирает строки stats_query в статистику по группам"""
+    result = {}
+    for row in rows:
+        stats = result.get(row.grp)
+        if stats is None:
+            width = (row.high - row.low + 1) / bins
+            stats = result[row.grp] = {
+                "group": row.grp if grouped else None,
+                "count": int(row.count),
+                "min": row.min,
+                "max": row.max,
+                "mean": row.sum / row.count,
+                "percentiles": {f"p{percent}": _percentile(row, percent) for percent in PERCENTILES},
+                "histogram": [
+                    {"lower": row.low + width * index, "upper": row.low + width * (index + 1), "count": 0}
+                    for index in range(bins)
+                ],
+            }
+        stats["histogram"][int(row.bucket)]["count"] = int(row.bucket_count)
+    return list(result.values())
+
+
+async def item_value_stats(db: AsyncSession, bins: int = 10, prefix_length: int = None,
+                           source: str = "live", **filters) -> list[dict]:
+    """Статистика value по строкам test_items или по сводке"""
+    if source == "summary":
+        values = _summary_values(filters.get("value_min"), filters.get("value_max"))
+    else:
+        values = _live_values(db, prefix_length, **filters)
+    result = await db.execute(stats_query(values, bins))
+    return summarize(result.all(), bins, grouped=bool(prefix_length))
@@ -3,6 +3,13 @@
 включая хеширование паролей, создание и проверку JWT токенов.
 """
 
+import asyncio
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
@@ -13,13 +20,83 @@ from .config import settings
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+
+class PasswordHasher:
+    """Выполняет bcrypt в отдельном ограниченном пуле потоков.
+
+    bcrypt отпускает GIL, поэтому потоки хешируют параллельно, а цикл событий
+    не блокируется. Пул отделен от пула по умолчанию, так что всплеск входов
+    не забирает потоки у остальных обработчиков.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hasher")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._max_queue_depth = 0
+        self._completed = 0
+        self._wait_seconds = 0.0
+
+    async def _run(self, func, *args):
+        """Ставит вызов в очередь пула и учитывает время ожидания"""
+        submitted = time.perf_counter()
+
+        def task():
+            with self._lock:
+                self._running += 1
+                self._wait_seconds += time.perf_counter() - submitted
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        with self._lock:
+            self._pending += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._pending - self._running)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, task)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """Генерирует хеш пароля"""
+        return await self._run(pwd_context.hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """Проверяет соответствие пароля и хеша"""
+        return await self._run(pwd_context.verify, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        """Текущее состояние пула и очереди"""
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "running": self._running,
+                "queue_depth": self._pending - self._running,
+                "max_queue_depth": self._max_queue_depth,
+                "completed": self._completed,
+                "wait_seconds_total": round(self._wait_seconds, 6),
+            }
+
+    def shutdown(self):
+        """Останавливает пул потоков"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Проверяет соответствие пароля и хеша"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return await password_hasher.verify(plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
+async def get_password_hash(password: str) -> str:
     """Генерирует хеш пароля"""
-    return pwd_context.hash(password)
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict) -> str:
     """Создает JWT токен с указанными данными"""
@@ -36,7 +113,8 @@ def create_refresh_token(data: dict, expires_delta: timedelta = timedelta(days=7
     """Создает Refresh Token"""
     to_encode = data.copy()
     expire = datetime.utcnow() + expires_delta
-    to_encode.update({"exp": expire})
+    # jti делает токены уникальными даже при выдаче в одну секунду
+    to_encode.update({"exp": expire, "jti": secrets.token_urlsafe(8)})
     return jwt.encode(
         to_encode,
         settings.SECRET_KEY,
@@ -55,6 +133,69 @@ def decode_token(token: str) -> dict:
     except JWTError:
         return None
 
+class TokenCache:
+    """LRU-кэш проверенных access-токенов.
+
+    Ключ — SHA-256 от полного токена (вместе с подписью), поэтому попадание
+    возможно только для тех же байтов, что уже прошли проверку подписи.
+    Запись живет до момента exp из самого токена.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        """Возвращает сохраненные claims или None"""
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def put(self, token: str, payload: dict):
+        """Сохраняет claims проверенного токена"""
+        expires_at = payload.get("exp")
+        if self.max_size <= 0 or expires_at is None:
+            return
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE)
+
+def decode_token_cached(token: str) -> dict:
+    """Декодирует access-токен, используя кэш уже проверенных токенов"""
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = decode_token(token)
+        if payload:
+            token_cache.put(token, payload)
+    return payload
+
+def hash_token(token: str) -> str:
+    """Короткий дайджест фиксированной длины для хранения токена в БД"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
 def verify_refresh_token(token: str) -> dict:
     """Проверяет Refresh Token"""
     return decode_token(token)
@@ -0,0 +1,216 @@
+"""
+Файл содержит кэш ответов для чтения элементов и комментариев:
+сменные хранилища (память процесса, сервер с протоколом Redis),
+read-through загрузку, инвалидацию по пространствам имен и ETag.
+"""
+
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict
+from fastapi import Request, Response, status
+from .config import settings
+
+
+class NullCache:
+    """Хранилище-заглушка: кэширование выключено"""
+
+    async def get(self, key: str):
+        return None
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        pass
+
+    async def set_version(self, key: str, value: str, ttl: int):
+        pass
+
+
+class MemoryCache:
+    """LRU-кэш в памяти процесса с TTL.
+
+    Инвалидация видна только текущему процессу, при нескольких воркерах
+    устаревание ограничено TTL — для общего кэша нужен RedisCache.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # Версии хранятся отдельно, чтобы LRU их не вытеснял; истекшие удаляются по TTL
+        self._versions = {}
+
+    async def get(self, key: str):
+        if key in self._versions:
+            expires_at, value = self._versions[key]
+            if expires_at > time.monotonic():
+                return value
+            del self._versions[key]
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def set_version(self, key: str, value: str, ttl: int):
+        now = time.monotonic()
+        self._versions[key] = (now + ttl, value)
+        if len(self._versions) > self.max_entries:
+            self._versions = {k: v for k, v in self._versions.items() if v[0] > now}
+
+
+class RedisCache:
+    """Кэш на сервере с протоколом Redis.
+
+    Принимает любой асинхронный клиент с методами get/set,
+    например redis.asyncio.Redis или fakeredis для тестов.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    @classmethod
+    def from_url(cls, url: str):
+        import redis.asyncio as redis
+
+        return cls(redis.from_url(url))
+
+    async def get(self, key: str):
+        return await self._client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        await self._client.set(key, value, ex=ttl)
+
+    async def set_version(self, key: str, value: str, ttl: int):
+        await self._client.set(key, value, ex=ttl)
+
+
+class ResponseCache:
+    """Read-through кэш сериализованных ответов.
+
+    Ключи группируются по пространствам имен (например, "item:5" или "items").
+    Инвалидация записывает новую уникальную версию пространства, и старые
+    записи больше не читаются, а затем вытесняются по TTL/LRU. Версия
+    живет дольше любой записи (version_ttl > ttl), поэтому после ее
+    истечения пространство без версии не может вернуть старые записи,
+    а число хранимых версий ограничено недавно измененными пространствами.
+    """
+
+    def __init__(self, backend, ttl: int, prefix: str = "api", settle_seconds: int = 0):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        # Сколько секунд после инвалидации не сохранять значения, прочитанные с реплик
+        self.settle_seconds = settle_seconds
+        self.version_ttl = 2 * ttl + settle_seconds
+        self.hits = 0
+        self.misses = 0
+
+    async def _key(self, namespace: str, key: str) -> str:
+        version = await self.backend.get(f"{self.prefix}:{namespace}:version")
+        if isinstance(version, bytes):
+            version = version.decode()
+        return f"{self.prefix}:{namespace}:v{version or 0}:{key}"
+
+    async def get_or_load(self, namespace: str, key: str, loader, lagging: bool = False):
+        """Возвращает значение из кэша или загружает и сохраняет его.
+
+        lagging — загрузка идет с реплики: сразу после инвалидации реплика
+        может отдать старые данные, и такое значение не сохраняется.
+        """
+        full_key = await self._key(namespace, key)
+        value = await self.backend.get(full_key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await loader()
+        if value is None:
+            return value
+        if lagging and await self.backend.get(f"{self.prefix}:{namespace}:changed") is not None:
+            return value
+        await self.backend.set(full_key, value, self.ttl)
+        return value
+
+    async def invalidate(self, *namespaces: str):
+        """Делает недействительными все записи указанных пространств имен"""
+        for namespace in namespaces:
+            # Уникальная, а не возрастающая версия: после истечения ключа номера не повторяются
+            await self.backend.set_version(f"{self.prefix}:{namespace}:version", uuid.uuid4().hex[:16],
+                                           self.version_ttl)
+            if self.settle_seconds:
+                await self.backend.set_version(f"{self.prefix}:{namespace}:changed", "1", self.settle_seconds)
+
+    def stats(self) -> dict:
+        """Счетчики попаданий и промахов"""
+        return {"backend": type(self.backend).__name__, "hits": self.hits, "misses": self.misses}
+
+
+def create_backend():
+    """Создает хранилище по настройке CACHE_BACKEND"""
+    if settings.CACHE_BACKEND == "redis":
+        return RedisCache.from_url(settings.CACHE_URL)
+    if settings.CACHE_BACKEND == "memory":
+        return MemoryCache(settings.CACHE_MAX_ENTRIES)
+    return NullCache()
+
+
+response_cache = ResponseCache(
+    create_backend(), settings.CACHE_TTL,
+    settle_seconds=settings.DB_REPLICA_STICKY_SECONDS if settings.DB_REPLICA_URLS.strip() else 0
+)
+
+
+async def load_cached(request: Request, namespace: str, key: str, loader):
+    """Read-through загрузка с учетом источника чтения запроса (request.state.db_source).
+
+    Чтения, закрепленные за основной БД после записи клиента, идут мимо
+    общего кэша: там может лежать ответ, прочитанный с отстающей реплики.
+    """
+    source = getattr(request.state, "db_source", "primary")
+    if source == "sticky":
+        return await loader()
+    return await response_cache.get_or_load(namespace, key, loader, lagging=source == "replica")
+
+
+def pack_response(body: bytes, headers: dict = None) -> bytes:
+    """Упаковывает тело ответа вместе с дополнительными заголовками"""
+    return json.dumps(headers or {}).encode() + b"\n" + body
+
+
+def unpack_response(value: bytes) -> tuple[bytes, dict]:
+    """Распаковывает значение, сохраненное pack_response"""
+    headers, body = value.split(b"\n", 1)
+    return body, json.loads(headers)
+
+
+def etag_for(body: bytes) -> str:
+    """ETag по содержимому тела ответа"""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def json_response(request: Request, value: bytes) -> Response:
+    """Строит JSON-ответ с ETag или 304, если клиент прислал тот же If-None-Match"""
+    body, headers = unpack_response(value)
+    etag = etag_for(body)
+    headers["ETag"] = etag
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def request_key(request: Request) -> str:
+    """Ключ запроса по пути и параметрам: маршруты одного пространства имен не смешиваются"""
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return hashlib.sha256(f"{request.url.path}?{params}".encode()).hexdigest()[:32]
@@ -4,14 +4,31 @@
 а также получение пользователей и тестовых элементов.
 """
 
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, insert, update, delete, func, literal, or_, and_, case, true
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
-from .models import TestTable, User, RefreshToken, Comment
-from . import schemas
-from passlib.context import CryptContext
+from .models import TestTable, User, RefreshToken, Comment, ImportJob, IdempotencyKey
+from . import schemas, search
+from .cache import response_cache
+from .auth import get_password_hash, verify_password, hash_token
+from datetime import datetime
 
-# Настройка хеширования паролей
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# INSERT с поддержкой ON CONFLICT для диалектов, которые его умеют
+DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+def dialect_insert(db: AsyncSession, model):
+    """Возвращает INSERT диалекта текущего подключения"""
+    return DIALECT_INSERTS.get(db.get_bind().dialect.name, insert)(model)
+
+
+# Ключ advisory-блокировки PostgreSQL для выбора роли первого пользователя
+FIRST_ADMIN_LOCK_ID = 72_310_002
 
 
 # Функции для пользователей
@@ -20,17 +37,56 @@ async def get_user(db: AsyncSession, username: str):
     return result.scalars().first()
 
 
-async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
-    result = await db.execute(select(User).offset(skip).limit(limit))
+def users_page_query(skip: int = 0, limit: int = 100, after_id: int = None):
+    """Запрос страницы пользователей, упорядоченной по id"""
+    query = select(User).order_by(User.id)
+    # Keyset-пагинация по id, если передан курсор, иначе OFFSET
+    if after_id is not None:
+        query = query.filter(User.id > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit)
+
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int = None):
+    result = await db.execute(users_page_query(skip=skip, limit=limit, after_id=after_id))
     return result.scalars().all()
 
 
-async def create_user(db: AsyncSession, user: schemas.UserCreate):
-    hashed_password = pwd_context.hash(user.password)
-    db_user = User(username=user.username, hashed_password=hashed_password, role=user.role)
-    db.add(db_user)
+async def username_taken(db: AsyncSession, username: str) -> bool:
+    """Проверяет занятость имени запросом EXISTS по уникальному индексу"""
+    result = await db.execute(select(select(User.id).where(User.username == username).exists()))
+    return bool(result.scalar())
+
+
+async def create_user_if_absent(db: AsyncSession, user: schemas.UserCreate):
+    """Создает пользователя одним INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING.
+
+    Если роль не задана, первый пользователь в базе становится
+    администратором: решение принимается в том же операторе. В PostgreSQL
+    (READ COMMITTED) две одновременные первые регистрации увидели бы пустую
+    таблицу, поэтому вставки без роли сериализуются advisory-блокировкой
+    до конца транзакции; SQLite и так выполняет записи по одной. Занятость
+    имени проверяется до хеширования пароля, чтобы повторная регистрация
+    не тратила время на bcrypt; ON CONFLICT закрывает гонку между
+    проверкой и вставкой. Возвращает None, если имя уже занято.
+    """
+    if await username_taken(db, user.username):
+        return None
+    hashed_password = await get_password_hash(user.password)
+    if not user.role and db.get_bind().dialect.name == "postgresql":
+        # Блокировка берется после bcrypt: сериализуется только вставка
+        await db.execute(select(func.pg_advisory_xact_lock(FIRST_ADMIN_LOCK_ID)))
+    role = literal(user.role) if user.role else case(
+        (select(User.id).exists(), literal("user")), else_=literal("admin")
+    )
+    source = select(literal(user.username), literal(hashed_password), role).where(true())
+    stmt = dialect_insert(db, User).from_select([User.username, User.hashed_password, User.role], source)
+    if hasattr(stmt, "on_conflict_do_nothing"):
+        stmt = stmt.on_conflict_do_nothing(index_elements=[User.username])
+    result = await db.execute(stmt.returning(User))
+    db_user = result.scalars().first()
     await db.commit()
-    await db.refresh(db_user)
     return db_user
 
 
@@ -38,71 +94,218 @@ async def update_user(db: AsyncSession, username: str, user_update: schemas.User
     stmt = update(User).where(User.username == username)
     values = {}
     if user_update.password:
-        values["hashed_password"] = pwd_context.hash(user_update.password)
+        values["hashed_password"] = await get_password_hash(user_update.password)
     if user_update.role:
         values["role"] = user_update.role
-    if values:
-        await db.execute(stmt.values(**values))
-        await db.commit()
-    result = await db.execute(select(User).filter(User.username == username))
-    return result.scalars().first()
+    if not values:
+        return await get_user(db, username)
+    result = await db.execute(stmt.values(**values).returning(User))
+    db_user = result.scalars().first()
+    await db.commit()
+    return db_user
 
 
 async def delete_user(db: AsyncSession, username: str):
-    result = await db.execute(select(User).filter(User.username == username))
-    user = result.scalars().first()
-    if user:
-        await db.execute(delete(User).where(User.username == username))
-        await db.commit()
-        return True
-    return False
+    result = await db.execute(delete(User).where(User.username == username).returning(User.id))
+    deleted = result.first() is not None
+    await db.commit()
+    return deleted
 
 
-# Функции для refresh-токенов
-async def get_refresh_token(db: AsyncSession, token: str):
-    result = await db.execute(select(RefreshToken).filter(RefreshToken.token == token))
-    return result.scalars().first()
+# Функции для refresh-токенов (в БД хранится только SHA-256 от токена)
+async def create_refresh_token(db: AsyncSession, user_id: int, token: str, expires_at):
+    stmt = insert(RefreshToken).values(user_id=user_id, token_hash=hash_token(token), expires_at=expires_at)
+    await db.execute(stmt)
+    await db.commit()
 
 
-async def create_refresh_token(db: AsyncSession, user_id: int, token: str, expires_at):
-    db_token = RefreshToken(user_id=user_id, token=token, expires_at=expires_at)
-    db.add(db_token)
+async def rotate_refresh_token(db: AsyncSession, token: str, new_token: str, expires_at, username: str):
+    """Заменяет действующий токен новым одним UPDATE.
+
+    Возвращает строку (id, username, role) владельца токена или None,
+    если токен не найден, истек или принадлежит другому пользователю.
+    Данные пользователя читаются подзапросами в RETURNING, отдельный
+    SELECT не нужен.
+    """
+    owner = select(User.id).where(User.username == username).scalar_subquery()
+    stmt = (
+        update(RefreshToken)
+        .where(
+            RefreshToken.token_hash == hash_token(token),
+            RefreshToken.expires_at > datetime.utcnow(),
+            RefreshToken.user_id == owner,
+        )
+        .values(token_hash=hash_token(new_token), expires_at=expires_at)
+        .returning(
+            RefreshToken.user_id.label("id"),
+            select(User.username).where(User.id == RefreshToken.user_id).scalar_subquery().label("username"),
+            select(User.role).where(User.id == RefreshToken.user_id).scalar_subquery().label("role"),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    user = result.first()
     await db.commit()
-    await db.refresh(db_token)
-    return db_token
+    return user
 
 
 async def delete_refresh_token(db: AsyncSession, token: str):
-    await db.execute(delete(RefreshToken).where(RefreshToken.token == token))
+    await db.execute(delete(RefreshToken).where(RefreshToken.token_hash == hash_token(token)))
     await db.commit()
 
 
+async def delete_expired_refresh_tokens(db: AsyncSession, batch_size: int) -> int:
+    """Удаляет не больше batch_size истекших токенов и возвращает их количество"""
+    expired_ids = (
+        select(RefreshToken.id)
+        .where(RefreshToken.expires_at <= datetime.utcnow())
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    result = await db.execute(delete(RefreshToken).where(RefreshToken.id.in_(expired_ids)))
+    await db.commit()
+    return result.rowcount
+
+
 # Функции для тестовых элементов
 async def create_test_item(db: AsyncSession, item: schemas.TestItemCreate):
     db_item = TestTable(**item.dict())
     db.add(db_item)
     await db.commit()
     await db.refresh(db_item)
+    await response_cache.invalidate("items", "items_comments")
     return db_item
 
 
-async def get_test_items(db: AsyncSession, skip: int = 0, limit: int = 100, name: str = None, value_min: int = None,
-                         value_max: int = None):
-    query = select(TestTable)
+def _item_rows(items: list) -> list[dict]:
+    """Строки для вставки: схемы TestItemCreate или уже проверенные словари"""
+    return [item if isinstance(item, dict) else item.dict() for item in items]
+
+
+async def bulk_create_test_items(db: AsyncSession, items: list, commit: bool = True):
+    """Вставляет элементы многострочным INSERT ... RETURNING.
+
+    Ответ строится из возвращенных строк, поэтому повторные SELECT
+    для каждой записи (refresh) не нужны.
+    """
+    if not items:
+        return []
+    stmt = insert(TestTable).returning(TestTable, sort_by_parameter_order=True)
+    result = await db.execute(stmt, _item_rows(items))
+    db_items = result.scalars().all()
+    if commit:
+        await db.commit()
+        await response_cache.invalidate("items", "items_comments")
+    return db_items
+
+
+async def upsert_test_items(db: AsyncSession, items: list, key_columns: list[str]):
+    """Вставляет или обновляет элементы по естественному ключу одним INSERT ... ON CONFLICT DO UPDATE.
+
+    Строки с одинаковым ключом внутри пакета схлопываются (побеждает
+    последняя): один оператор не может обновить строку дважды.
+    """
+    rows = {tuple(row[column] for column in key_columns): row for row in _item_rows(items)}
+    if not rows:
+        return []
+    stmt = dialect_insert(db, TestTable)
+    updated = {column: stmt.excluded[column] for column in ("name", "description", "value") if column not in key_columns}
+    stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=updated)
+    result = await db.execute(stmt.returning(TestTable, sort_by_parameter_order=True), list(rows.values()))
+    db_items = result.scalars().all()
+    await db.commit()
+    await response_cache.invalidate("items", "items_comments")
+    return db_items
+
+
+async def insert_test_items(db: AsyncSession, items: list) -> int:
+    """Вставляет элементы пакетом без возврата строк и возвращает их количество"""
+    if not items:
+        return 0
+    await db.execute(insert(TestTable), _item_rows(items))
+    await db.commit()
+    await response_cache.invalidate("items", "items_comments")
+    return len(items)
+
+
+def test_items_query(db: AsyncSession, name: str = None, value_min: int = None, value_max: int = None,
+                     search_mode: str = "substring", rank: bool = False):
+    """Запрос элементов с фильтрами списка, упорядоченный по id"""
+    query = select(TestTable).order_by(TestTable.id)
 
     # Добавляем фильтры, если параметры указаны
     if name:
-        query = query.filter(TestTable.name.ilike(f"%{name}%"))
+        query = search.apply_name_search(query, name, search_mode, rank, db.get_bind().dialect.name)
     if value_min is not None:
         query = query.filter(TestTable.value >= value_min)
     if value_max is not None:
         query = query.filter(TestTable.value <= value_max)
+    return query
+
+
+def test_items_page_query(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int = None, **filters):
+    """Запрос страницы элементов с фильтрами списка"""
+    query = test_items_query(db, **filters)
+
+    # Keyset-пагинация по id, если передан курсор, иначе OFFSET
+    if after_id is not None:
+        query = query.filter(TestTable.id > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit)
 
-    query = query.offset(skip).limit(limit)
+
+async def get_test_items(db: AsyncSession, skip: int = 0, limit: int = 100, name: str = None, value_min: int = None,
+                         value_max: int = None, after_id: int = None, search_mode: str = "substring",
+                         rank: bool = False):
+    query = test_items_page_query(db, skip=skip, limit=limit, after_id=after_id, name=name, value_min=value_min,
+                                  value_max=value_max, search_mode=search_mode, rank=rank)
     result = await db.execute(query)
     return result.scalars().all()
 
 
+async def get_test_items_with_comments(db: AsyncSession, comments_limit: int = 20, **page):
+    """Страница элементов вместе с первыми comments_limit комментариями каждого.
+
+    Два запроса на всю страницу: элементы и комментарии к ним. Лимит на
+    элемент задается оконной функцией row_number(), поэтому одно большое
+    обсуждение не тянет за собой все свои строки. Лишняя строка сверх
+    лимита только отмечает has_more_comments.
+    """
+    items = await get_test_items(db, **page)
+    comments = {item.id: [] for item in items}
+    if items:
+        position = func.row_number().over(
+            partition_by=Comment.item_id, order_by=(Comment.created_at, Comment.id)
+        ).label("position")
+        ranked = (
+            select(Comment, position)
+            .where(Comment.item_id.in_(list(comments)))
+            .subquery()
+        )
+        ranked_comment = aliased(Comment, ranked)
+        result = await db.execute(
+            select(ranked_comment)
+            .where(ranked.c.position <= comments_limit + 1)
+            .order_by(ranked.c.item_id, ranked.c.position)
+        )
+        for comment in result.scalars():
+            comments[comment.item_id].append(comment)
+    for item in items:
+        item_comments = comments[item.id]
+        item.has_more_comments = len(item_comments) > comments_limit
+        set_committed_value(item, "comments", item_comments[:comments_limit])
+    return items
+
+
+async def stream_test_items(db: AsyncSession, batch_size: int, **filters):
+    """Отдает элементы пакетами через серверный курсор (yield_per), не загружая результат целиком"""
+    query = test_items_query(db, **filters).execution_options(yield_per=batch_size)
+    result = await db.stream_scalars(query)
+    async for batch in result.partitions():
+        yield batch
+
+
 async def get_test_item(db: AsyncSession, item_id: int):
     result = await db.execute(select(TestTable).filter(TestTable.id == item_id))
     return result.scalars().first()
@@ -111,34 +314,65 @@ async def get_test_item(db: AsyncSession, item_id: int):
 async def update_test_item(db: AsyncSession, item_id: int, item_update: schemas.TestItemUpdate):
     stmt = update(TestTable).where(TestTable.id == item_id)
     values = {k: v for k, v in item_update.dict(exclude_unset=True).items()}
-    if values:
-        await db.execute(stmt.values(**values))
-        await db.commit()
-    result = await db.execute(select(TestTable).filter(TestTable.id == item_id))
-    return result.scalars().first()
+    if not values:
+        return await get_test_item(db, item_id)
+    result = await db.execute(stmt.values(**values).returning(TestTable))
+    db_item = result.scalars().first()
+    await db.commit()
+    await response_cache.invalidate(f"item:{item_id}", "items", "items_comments")
+    return db_item
 
 
 async def delete_test_item(db: AsyncSession, item_id: int):
-    result = await db.execute(select(TestTable).filter(TestTable.id == item_id))
-    item = result.scalars().first()
-    if item:
-        await db.execute(delete(TestTable).where(TestTable.id == item_id))
-        await db.commit()
-        return True
-    return False
+    result = await db.execute(delete(TestTable).where(TestTable.id == item_id).returning(TestTable.id))
+    deleted = result.first() is not None
+    await db.commit()
+    await response_cache.invalidate(f"item:{item_id}", "items", "items_comments", f"comments:{item_id}")
+    return deleted
 
 
 # Функции для комментариев
 async def create_comment(db: AsyncSession, item_id: int, comment: schemas.CommentCreate, author: str):
-    db_comment = Comment(item_id=item_id, text=comment.text, author=author)
-    db.add(db_comment)
+    """Добавляет комментарий одним INSERT ... SELECT ... RETURNING.
+
+    Строка вставляется, только если элемент существует; иначе
+    возвращается None, отдельная проверка элемента не нужна.
+    """
+    source = (
+        select(TestTable.id, literal(author), literal(comment.content), literal(datetime.utcnow()))
+        .where(TestTable.id == item_id)
+    )
+    stmt = (
+        insert(Comment)
+        .from_select([Comment.item_id, Comment.author, Comment.content, Comment.created_at], source)
+        .returning(Comment)
+    )
+    result = await db.execute(stmt)
+    db_comment = result.scalars().first()
     await db.commit()
-    await db.refresh(db_comment)
+    if db_comment:
+        await response_cache.invalidate(f"comments:{item_id}", "items_comments")
     return db_comment
 
 
-async def get_comments(db: AsyncSession, item_id: int):
-    result = await db.execute(select(Comment).filter(Comment.item_id == item_id))
+def comments_query(item_id: int, limit: int = 100, after: tuple = None):
+    """Запрос страницы комментариев элемента в порядке (created_at, id).
+
+    after — ключ (created_at, id) последней строки предыдущей страницы;
+    запрос обслуживается индексом ix_comments_item_id_created_at.
+    """
+    query = select(Comment).filter(Comment.item_id == item_id).order_by(Comment.created_at, Comment.id)
+    if after is not None:
+        created_at, last_id = after
+        query = query.filter(or_(
+            Comment.created_at > created_at,
+            and_(Comment.created_at == created_at, Comment.id > last_id),
+        ))
+    return query.limit(limit)
+
+
+async def get_comments(db: AsyncSession, item_id: int, limit: int = 100, after: tuple = None):
+    result = await db.execute(comments_query(item_id, limit=limit, after=after))
     return result.scalars().all()
 
 
@@ -147,16 +381,159 @@ async def get_comment(db: AsyncSession, comment_id: int):
     return result.scalars().first()
 
 
-async def delete_comment(db: AsyncSession, comment_id: int):
+async def delete_comment(db: AsyncSession, comment_id: int, item_id: int):
     await db.execute(delete(Comment).where(Comment.id == comment_id))
     await db.commit()
+    await response_cache.invalidate(f"comments:{item_id}", "items_comments")
+
+
+# Функции для заданий импорта
+async def create_import_job(db: AsyncSession, job_id: str, file_format: str, path: str, owner: str):
+    result = await db.execute(
+        insert(ImportJob)
+        .values(id=job_id, file_format=file_format, path=path, owner=owner, status="queued", errors=[],
+                created_at=datetime.utcnow())
+        .returning(ImportJob)
+    )
+    job = result.scalars().first()
+    await db.commit()
+    return job
+
+
+async def get_import_job(db: AsyncSession, job_id: str):
+    result = await db.execute(select(ImportJob).filter(ImportJob.id == job_id))
+    return result.scalars().first()
+
+
+async def claim_import_job(db: AsyncSession):
+    """Забирает самое старое задание из очереди одним UPDATE.
+
+    Условие status = 'queued' в самом UPDATE не дает двум воркерам
+    (в том числе в разных процессах) взять одно задание.
+    """
+    now = datetime.utcnow()
+    oldest = (
+        select(ImportJob.id)
+        .where(ImportJob.status == "queued")
+        .order_by(ImportJob.created_at)
+        .limit(1)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        update(ImportJob)
+        .where(ImportJob.id == oldest, ImportJob.status == "queued")
+        .values(status="running", started_at=now, updated_at=now)
+        .returning(ImportJob)
+        .execution_options(synchronize_session=False)
+    )
+    job = result.scalars().first()
+    await db.commit()
+    return job
+
+
+async def update_import_job(db: AsyncSession, job_id: str, **values):
+    await db.execute(
+        update(ImportJob)
+        .where(ImportJob.id == job_id)
+        .values(updated_at=datetime.utcnow(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+async def fail_stale_import_jobs(db: AsyncSession, stale_before: datetime) -> int:
+    """Помечает неудачными задания, воркер которых перестал сообщать о прогрессе"""
+    result = await db.execute(
+        update(ImportJob)
+        .where(ImportJob.status == "running", ImportJob.updated_at < stale_before)
+        .values(status="failed", error="Import worker stopped", finished_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def prune_import_jobs(db: AsyncSession, keep: int) -> int:
+    """Удаляет самые старые завершенные задания сверх лимита"""
+    expired = (
+        select(ImportJob.id)
+        .where(ImportJob.finished_at.isnot(None))
+        .order_by(ImportJob.finished_at.desc())
+        .offset(keep)
+        .scalar_subquery()
+    )
+    result = await db.execute(delete(ImportJob).where(ImportJob.id.in_(expired)))
+    await db.commit()
+    return result.rowcount
+
+
+# Функции для ключей идемпотентности
+async def reserve_idempotency_key(db: AsyncSession, owner: str, key_hash: str, fingerprint: str,
+                                  expires_at: datetime) -> bool:
+    """Резервирует ключ; False — ключ уже занят действующей записью.
+
+    Уникальный индекс (owner, key_hash) делает резерв атомарным
+    между запросами и процессами.
+    """
+    await db.execute(
+        delete(IdempotencyKey)
+        .where(IdempotencyKey.owner == owner, IdempotencyKey.key_hash == key_hash,
+               IdempotencyKey.expires_at <= datetime.utcnow())
+    )
+    stmt = (
+        dialect_insert(db, IdempotencyKey)
+        .values(owner=owner, key_hash=key_hash, fingerprint=fingerprint, expires_at=expires_at)
+        .on_conflict_do_nothing(index_elements=["owner", "key_hash"])
+        .returning(IdempotencyKey.id)
+    )
+    reserved = (await db.execute(stmt)).first() is not None
+    await db.commit()
+    return reserved
+
+
+async def get_idempotency_key(db: AsyncSession, owner: str, key_hash: str):
+    result = await db.execute(
+        select(IdempotencyKey).where(IdempotencyKey.owner == owner, IdempotencyKey.key_hash == key_hash)
+    )
+    return result.scalars().first()
+
+
+async def complete_idempotency_key(db: AsyncSession, owner: str, key_hash: str, status_code: int, body: bytes,
+                                   expires_at: datetime):
+    await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.owner == owner, IdempotencyKey.key_hash == key_hash)
+        .values(status_code=status_code, body=body, expires_at=expires_at)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+async def delete_idempotency_key(db: AsyncSession, owner: str, key_hash: str):
+    await db.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.owner == owner, IdempotencyKey.key_hash == key_hash)
+    )
+    await db.commit()
+
+
+async def delete_expired_idempotency_keys(db: AsyncSession, batch_size: int) -> int:
+    """Удаляет не больше batch_size истекших ключей и возвращает их количество"""
+    expired_ids = (
+        select(IdempotencyKey.id)
+        .where(IdempotencyKey.expires_at <= datetime.utcnow())
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    result = await db.execute(delete(IdempotencyKey).where(IdempotencyKey.id.in_(expired_ids)))
+    await db.commit()
+    return result.rowcount
 
 
 # Функции для аутентификации
 class Auth:
     @staticmethod
-    def verify_password(plain_password, hashed_password):
-        return pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(plain_password, hashed_password):
+        return await verify_password(plain_password, hashed_password)
 
     @staticmethod
     def create_access_token(data: dict):
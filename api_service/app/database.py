@@ -3,15 +3,130 @@
 предоставляет сессию для взаимодействия с базой данных.
 """
 
+import hashlib
+import hmac
+import itertools
+import threading
+import time
+from fastapi import Request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from .config import settings
+from .auth import decode_token_cached
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """Пул подключений, учитывающий выдачи, время ожидания и исчерпание"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        # Все подключения заняты и лимит overflow выбран — запрос будет ждать
+        exhausted = self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.exhausted += exhausted
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def stats(self) -> dict:
+        """Счетчики пула и его текущее заполнение"""
+        with self._metrics_lock:
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "overflow": self.overflow(),
+                "checkouts": self.checkouts,
+                "exhausted": self.exhausted,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+
+
+def engine_options(url: str) -> dict:
+    """Параметры движка и пула подключений из настроек"""
+    url = make_url(url)
+    options = {
+        "echo": settings.DB_ECHO,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "query_cache_size": settings.DB_QUERY_CACHE_SIZE,
+    }
+    # SQLite в памяти живет внутри одного подключения (StaticPool), пул ему не нужен
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update(
+            poolclass=MeteredQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    return options
+
+
+def pool_stats(engine) -> dict:
+    """Метрики пула движка (пустые, если пул без учета)"""
+    pool = engine.sync_engine.pool
+    return pool.stats() if isinstance(pool, MeteredQueuePool) else {"status": pool.status()}
+
+
+def enable_sqlite_foreign_keys(engine):
+    """Включает проверку внешних ключей в каждом подключении SQLite.
+
+    Без PRAGMA foreign_keys SQLite не проверяет ограничения и не
+    выполняет ON DELETE CASCADE (комментарии удаленного элемента,
+    refresh-токены удаленного пользователя).
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 
 Base = declarative_base()
-engine = create_async_engine(
-    settings.DB_URL,
-    echo=True  # Логирование SQL запросов для отладки
-)
+engine = create_async_engine(settings.DB_URL, **engine_options(settings.DB_URL))
+
+# Реплики только для чтения; без них все запросы идут на основную БД
+replica_engines = [
+    create_async_engine(url, **engine_options(url))
+    for url in (url.strip() for url in settings.DB_REPLICA_URLS.split(","))
+    if url
+]
+_next_replica = itertools.cycle(replica_engines)
+
+for _engine in (engine, *replica_engines):
+    enable_sqlite_foreign_keys(_engine)
+
+# Методы запросов, которые не изменяют данные
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Cookie, закрепляющая чтения клиента за основной БД после его записи
+STICKY_COOKIE = "db_primary_until"
 
 AsyncSessionLocal = sessionmaker(
         engine,
@@ -20,9 +135,64 @@ AsyncSessionLocal = sessionmaker(
         autocommit = False,
         autoflush=  False)
 
-async def get_db():
-    """Генератор сессий для зависимостей"""
-    async with AsyncSessionLocal() as session:
+
+def _request_user(request: Request):
+    """Имя пользователя из access-токена запроса (без обращения к БД)"""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    payload = decode_token_cached(token)
+    return payload.get("sub") if payload else None
+
+
+def _sticky_signature(username: str, expires: int) -> str:
+    message = f"{username}:{expires}".encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def sticky_cookie(username: str) -> str:
+    """Значение cookie закрепления: срок действия и подпись, привязанная к пользователю"""
+    expires = int(time.time()) + settings.DB_REPLICA_STICKY_SECONDS
+    return f"{expires}.{_sticky_signature(username, expires)}"
+
+
+def _is_sticky(request: Request, username: str) -> bool:
+    expires, _, signature = request.cookies.get(STICKY_COOKIE, "").partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _sticky_signature(username, int(expires)))
+
+
+def _bind_for(request: Request):
+    """Движок и источник чтения: реплика для чтений, основная БД для записей и чтений сразу после них"""
+    username = _request_user(request)
+    if request.method not in READ_METHODS:
+        if username:
+            request.state.db_writer = username
+        return engine, "primary"
+    if username and _is_sticky(request, username):
+        return engine, "sticky"
+    return next(_next_replica), "replica"
+
+
+def request_bind(request: Request):
+    """Движок запроса: выбирается один раз и сохраняется в request.state.db_bind.
+
+    Источник сохраняется в request.state.db_source: по нему кэш ответов
+    решает, можно ли отдавать и сохранять общие записи (см. cache.load_cached).
+    Потоковые ответы открывают свои сессии на этом же движке.
+    """
+    bind = getattr(request.state, "db_bind", None)
+    if bind is None:
+        bind, request.state.db_source = _bind_for(request) if replica_engines else (engine, "primary")
+        request.state.db_bind = bind
+    return bind
+
+
+async def get_db(request: Request):
+    """Генератор сессий для зависимостей с выбором основной БД или реплики"""
+    bind = request_bind(request)
+    async with AsyncSessionLocal(bind=bind) as session:
         try:
             yield session
             await session.commit()
@@ -30,4 +200,31 @@ async def get_db():
             await session.rollback()
             raise
         finally:
-            await session.close()
\ No newline at end of file
+            await session.close()
+
+
+class ReplicaStickinessMiddleware:
+    """ASGI-middleware, выдающее cookie закрепления после успешной записи.
+
+    Состояние хранится у клиента, а не в кэше, поэтому закрепление
+    работает с любым CACHE_BACKEND и в любом воркере. Окно отсчитывается
+    от отправки ответа, то есть после фиксации транзакции.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replica_engines:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            writer = scope.get("state", {}).get("db_writer")
+            if message["type"] == "http.response.start" and writer and message["status"] < 400:
+                cookie = (f"{STICKY_COOKIE}={sticky_cookie(writer)}; Max-Age={settings.DB_REPLICA_STICKY_SECONDS}; "
+                          f"Path=/; HttpOnly; SameSite=lax")
+                message["headers"] = [*message.get("headers", []), (b"set-cookie", cookie.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -4,12 +4,17 @@
 роли администратора.
 """
 
-from fastapi import Depends, HTTPException, status
-from .auth import oauth2_scheme, decode_token
+import hmac
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import crud
+from .auth import oauth2_scheme, decode_token_cached
+from .config import settings
+from .database import get_db
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     """Получает текущего пользователя из JWT токена"""
-    payload = decode_token(token)
+    payload = decode_token_cached(token)
     if not payload or "sub" not in payload:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -18,6 +23,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         )
     return {"username": payload["sub"], "role": payload.get("role", "user")}
 
+async def get_current_db_user(
+        request: Request,
+        current_user: dict = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+    """Загружает строку текущего пользователя не более одного раза за запрос.
+
+    Результат сохраняется в request.state.db_user и доступен
+    остальным зависимостям и обработчику без повторного запроса.
+    """
+    if not hasattr(request.state, "db_user"):
+        request.state.db_user = await crud.get_user(db, current_user["username"])
+    if request.state.db_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return request.state.db_user
+
 def require_admin(user: dict = Depends(get_current_user)):
     """Проверяет права администратора"""
     if user["role"] != "admin":
@@ -27,6 +51,24 @@ def require_admin(user: dict = Depends(get_current_user)):
         )
     return user
 
+def require_metrics_access(token: str = Depends(oauth2_scheme)):
+    """Пускает к /metrics по METRICS_TOKEN (для сборщика метрик) или по токену администратора"""
+    if settings.METRICS_TOKEN and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+        return {"username": "metrics", "role": "metrics"}
+    payload = decode_token_cached(token)
+    if not payload or "sub" not in payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if payload.get("role") != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    return {"username": payload["sub"], "role": "admin"}
+
 def require_user(user: dict = Depends(get_current_user)):
     """Проверяет аутентификацию пользователя"""
     if not user:
@@ -0,0 +1,111 @@
+"""
+Файл содержит потоковую выгрузку тестовых элементов в NDJSON, CSV и Parquet.
+Строки читаются из БД пакетами и сразу кодируются, поэтому полный
+результат не собирается в памяти.
+"""
+
+import csv
+import io
+from starlette.concurrency import run_in_threadpool
+from . import crud
+from .streaming import dumps
+from .config import settings
+from .database import AsyncSessionLocal
+
+# Выгружаемые столбцы test_items
+EXPORT_COLUMNS = ["id", "name", "description", "value"]
+
+# MIME-типы форматов выгрузки
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def _rows(batch) -> list[dict]:
+    return [{column: getattr(item, column) for column in EXPORT_COLUMNS} for item in batch]
+
+
+def _encode_ndjson(rows: list[dict]) -> bytes:
+    return b"".join(dumps(row) + b"\n" for row in rows)
+
+
+def _encode_csv(rows: list[dict], header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Поток, который накапливает записанные байты до следующего drain()"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def _export_parquet(batches):
+    """Пишет каждый пакет отдельной группой строк Parquet и сразу отдает байты"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("name", pa.string()),
+        ("description", pa.string()),
+        ("value", pa.int64()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        async for batch in batches:
+            table = pa.Table.from_pylist(_rows(batch), schema=schema)
+            await run_in_threadpool(writer.write_table, table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+async def export_items(file_format: str, bind, **filters):
+    """Асинхронно отдает выгрузку элементов в указанном формате по частям.
+
+    bind — движок запроса (database.request_bind), чтобы выгрузка читала с реплики.
+    """
+    async with AsyncSessionLocal(bind=bind) as db:
+        batches = crud.stream_test_items(db, settings.EXPORT_BATCH_ROWS, **filters)
+        if file_format == "parquet":
+            async for data in _export_parquet(batches):
+                yield data
+            return
+        header = True
+        async for batch in batches:
+            rows = _rows(batch)
+            if file_format == "csv":
+                yield _encode_csv(rows, header)
+                header = False
+            else:
+                yield _encode_ndjson(rows)
+        if file_format == "csv" and header:
+            yield _encode_csv([], header)
@@ -0,0 +1,84 @@
+"""
+Файл содержит поддержку заголовка Idempotency-Key: ключ резервируется
+в таблице idempotency_keys до начала записи, результат запроса
+сохраняется на IDEMPOTENCY_TTL, и повтор с тем же ключом возвращает
+сохраненный ответ без повторной записи в БД.
+
+Ключи хранятся в БД, а не в кэше ответов: кэш вытесняет записи по LRU
+и может быть выключен, а ключ должен жить весь срок IDEMPOTENCY_TTL
+и быть виден всем процессам. Истекшие ключи удаляет sweeper.
+"""
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from fastapi import HTTPException, Response, status
+from . import crud
+from .config import settings
+from .database import AsyncSessionLocal
+
+# Заголовок запроса с ключом идемпотентности
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+# Заголовок ответа, отмечающий повтор сохраненного результата
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def fingerprint(payload) -> str:
+    """Отпечаток тела запроса: ключ нельзя переиспользовать с другими данными"""
+    raw = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _key_hash(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+async def begin(owner: str, key: str, request_fingerprint: str):
+    """Резервирует ключ перед выполнением запроса.
+
+    Возвращает None, если ключ зарезервирован этим запросом, или
+    сохраненный ответ, если запрос с этим ключом уже выполнен.
+    Пока первый запрос выполняется, повторы получают 409.
+    """
+    expires_at = datetime.utcnow() + timedelta(seconds=settings.IDEMPOTENCY_PENDING_TTL)
+    async with AsyncSessionLocal() as db:
+        # Второй проход нужен, если чужой резерв удален между вставкой и чтением
+        for _ in range(2):
+            if await crud.reserve_idempotency_key(db, owner, _key_hash(key), request_fingerprint, expires_at):
+                return None
+            stored = await crud.get_idempotency_key(db, owner, _key_hash(key))
+            if stored is not None:
+                return _stored_response(stored, request_fingerprint)
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"A request with this {IDEMPOTENCY_HEADER} is already in progress"
+    )
+
+
+def _stored_response(stored, request_fingerprint: str) -> Response:
+    if stored.fingerprint != request_fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{IDEMPOTENCY_HEADER} was already used with a different payload"
+        )
+    if stored.status_code is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"A request with this {IDEMPOTENCY_HEADER} is already in progress"
+        )
+    return Response(content=stored.body, status_code=stored.status_code, media_type="application/json",
+                    headers={REPLAYED_HEADER: "true"})
+
+
+async def remember(owner: str, key: str, body: bytes, status_code: int):
+    """Заменяет резерв ответом для повторов с тем же ключом"""
+    expires_at = datetime.utcnow() + timedelta(seconds=settings.IDEMPOTENCY_TTL)
+    async with AsyncSessionLocal() as db:
+        await crud.complete_idempotency_key(db, owner, _key_hash(key), status_code, body, expires_at)
+
+
+async def release(owner: str, key: str):
+    """Снимает резерв неудачного запроса, чтобы клиент мог повторить его"""
+    async with AsyncSessionLocal() as db:
+        await crud.delete_idempotency_key(db, owner, _key_hash(key))
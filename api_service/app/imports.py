@@ -0,0 +1,112 @@
+"""
+Файл содержит подсистему фоновых импортов: загруженный файл сохраняется
+на диск и ставится в очередь, воркеры с ограниченной параллельностью
+разбирают его порциями, а ход выполнения доступен по id задания.
+
+Задания хранятся в таблице import_jobs, поэтому их состояние видно
+любому процессу приложения и переживает перезапуск. Файлы лежат в
+IMPORT_DIR, который должен быть общим для всех процессов.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+from fastapi import UploadFile
+from . import crud, ingest, validation
+from .config import settings
+from .database import AsyncSessionLocal
+from .models import ImportJob
+
+logger = logging.getLogger(__name__)
+
+
+class ImportManager:
+    """Очередь заданий импорта в БД и пул воркеров процесса"""
+
+    def __init__(self, workers: int, directory: str, max_jobs: int, poll_interval: float):
+        self.workers = workers
+        self.directory = directory
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self._wakeup = None
+        self._tasks = []
+
+    async def start(self):
+        """Запускает воркеры"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливает воркеры"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, file: UploadFile, file_format: str, suffix: str, owner: str) -> ImportJob:
+        """Сохраняет файл на диск и ставит задание в очередь"""
+        path = await ingest.save_upload(file, suffix=suffix, directory=self.directory)
+        async with AsyncSessionLocal() as db:
+            job = await crud.create_import_job(db, uuid.uuid4().hex, file_format, path, owner)
+            await crud.prune_import_jobs(db, self.max_jobs)
+        # Воркеры этого процесса берут задание сразу, остальные — при очередном опросе
+        self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[ImportJob]:
+        async with AsyncSessionLocal() as db:
+            return await crud.get_import_job(db, job_id)
+
+    async def _claim(self) -> Optional[ImportJob]:
+        async with AsyncSessionLocal() as db:
+            stale_before = datetime.utcnow() - timedelta(seconds=settings.IMPORT_STALE_SECONDS)
+            if await crud.fail_stale_import_jobs(db, stale_before):
+                logger.warning("Marked abandoned import jobs as failed")
+            return await crud.claim_import_job(db)
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception:
+                logger.exception("Cannot claim import job")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def _process(self, job: ImportJob):
+        """Проверяет и вставляет файл порциями, каждая порция — отдельная транзакция"""
+        report = validation.ValidationReport(keep_row_indices=False)
+        rows_inserted = 0
+        async with AsyncSessionLocal() as db:
+            try:
+                async for frame in ingest.iter_chunks(job.path, job.file_format):
+                    valid_rows = report.check(frame)
+                    rows_inserted += await crud.insert_test_items(db, valid_rows)
+                    await crud.update_import_job(
+                        db, job.id, rows_processed=report.rows_checked, rows_inserted=rows_inserted,
+                        rows_rejected=report.rows_rejected, errors=report.errors
+                    )
+                await crud.update_import_job(db, job.id, status="done", finished_at=datetime.utcnow())
+            except Exception as e:
+                logger.exception("Import job %s failed", job.id)
+                await db.rollback()
+                await crud.update_import_job(db, job.id, status="failed", error=str(e),
+                                             finished_at=datetime.utcnow())
+            finally:
+                if os.path.exists(job.path):
+                    os.remove(job.path)
+
+
+import_manager = ImportManager(settings.IMPORT_WORKERS, settings.IMPORT_DIR, settings.IMPORT_MAX_JOBS,
+                               settings.IMPORT_POLL_INTERVAL)
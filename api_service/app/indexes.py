@@ -0,0 +1,125 @@
+"""
+Файл описывает шаблоны запросов приложения и индексы, которые их обслуживают.
+При запуске объявленные индексы досоздаются на уже существующих таблицах,
+а шаблоны без подходящего индекса попадают в журнал.
+"""
+
+import logging
+from sqlalchemy import inspect, Index, MetaData, exc
+from .config import settings
+from .database import Base
+from . import models  # noqa: F401 — регистрирует таблицы в Base.metadata
+
+logger = logging.getLogger(__name__)
+
+# Шаблоны запросов из crud: таблица -> [(описание, столбцы фильтра по порядку)]
+QUERY_PATTERNS = {
+    "users": [
+        ("lookup by username", ["username"]),
+    ],
+    "refresh_tokens": [
+        ("lookup by token digest", ["token_hash"]),
+        ("tokens of a user", ["user_id"]),
+        ("expired tokens sweep", ["expires_at"]),
+    ],
+    "test_items": [
+        ("value range filter", ["value"]),
+    ],
+    "comments": [
+        ("comments of an item", ["item_id"]),
+        ("comments of an item by creation time", ["item_id", "created_at"]),
+    ],
+}
+
+
+def _existing_column_sets(inspector, table: str) -> list[list[str]]:
+    """Списки столбцов всех индексов, уникальных ограничений и первичного ключа таблицы"""
+    column_sets = [index["column_names"] for index in inspector.get_indexes(table)]
+    column_sets += [constraint["column_names"] for constraint in inspector.get_unique_constraints(table)]
+    column_sets.append(inspector.get_pk_constraint(table)["constrained_columns"])
+    return column_sets
+
+
+def find_missing_indexes(sync_conn) -> list[tuple[str, str, list[str]]]:
+    """Возвращает шаблоны запросов, для которых нет индекса с подходящим префиксом"""
+    inspector = inspect(sync_conn)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table, patterns in QUERY_PATTERNS.items():
+        if table not in tables:
+            continue
+        column_sets = _existing_column_sets(inspector, table)
+        for description, columns in patterns:
+            if not any(existing[:len(columns)] == columns for existing in column_sets):
+                missing.append((table, description, columns))
+    return missing
+
+
+def ensure_indexes(sync_conn):
+    """Создает объявленные в моделях индексы, которых еще нет в базе.
+
+    create_all пропускает уже существующие таблицы вместе с их индексами,
+    поэтому новые индексы на старых таблицах досоздаются здесь.
+    """
+    tables = set(inspect(sync_conn).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+def _upsert_key_columns() -> list[str]:
+    columns = [column.strip() for column in settings.UPSERT_KEY.split(",") if column.strip()]
+    unknown = [column for column in columns if column not in models.TestTable.__table__.c]
+    if unknown:
+        raise ValueError(f"UPSERT_KEY references unknown test_items columns: {', '.join(unknown)}")
+    return columns
+
+
+# Естественный ключ test_items для пакетного upsert (пусто — режим выключен)
+UPSERT_KEY_COLUMNS = _upsert_key_columns()
+
+# Уникальный индекс по ключу существует; без него ON CONFLICT невозможен
+upsert_index_ready = False
+
+
+def ensure_upsert_index(sync_conn, create: bool = True) -> bool:
+    """Создает (или, при create=False, только ищет) уникальный индекс по UPSERT_KEY.
+
+    Индекс не объявлен в модели: ключ настраивается, а на таблице с
+    дубликатами создание завершится ошибкой. В этом случае upsert
+    остается выключенным, а ошибка попадает в журнал.
+    """
+    global upsert_index_ready
+    if not UPSERT_KEY_COLUMNS:
+        return False
+    if not create:
+        unique_sets = [index["column_names"] for index in inspect(sync_conn).get_indexes("test_items")
+                       if index["unique"]]
+        upsert_index_ready = any(sorted(columns) == sorted(UPSERT_KEY_COLUMNS) for columns in unique_sets)
+        if not upsert_index_ready:
+            logger.error("No unique index on test_items(%s), upsert disabled", ", ".join(UPSERT_KEY_COLUMNS))
+        return upsert_index_ready
+    # Копия таблицы в отдельных метаданных: индекс не попадает в create_all и ensure_indexes
+    table = models.TestTable.__table__.to_metadata(MetaData())
+    columns = [table.c[column] for column in UPSERT_KEY_COLUMNS]
+    index = Index("ux_test_items_" + "_".join(UPSERT_KEY_COLUMNS), *columns, unique=True)
+    try:
+        with sync_conn.begin_nested():
+            index.create(sync_conn, checkfirst=True)
+    except exc.DBAPIError as e:
+        logger.error("Cannot create unique index on test_items(%s), upsert disabled: %s",
+                     ", ".join(UPSERT_KEY_COLUMNS), e.orig)
+        upsert_index_ready = False
+    else:
+        upsert_index_ready = True
+    return upsert_index_ready
+
+
+def report_missing_indexes(sync_conn) -> list[tuple[str, str, list[str]]]:
+    """Пишет в журнал шаблоны запросов без индекса"""
+    missing = find_missing_indexes(sync_conn)
+    for table, description, columns in missing:
+        logger.warning("No index on %s(%s) for query pattern: %s", table, ", ".join(columns), description)
+    return missing
@@ -0,0 +1,140 @@
+"""
+Файл содержит функции потоковой загрузки табличных данных
+(CSV, Excel, NDJSON, Parquet, Arrow IPC): сохранение загружаемого файла
+на диск блоками и чтение его порциями ограниченного размера, чтобы
+потребление памяти не зависело от размера файла.
+"""
+
+import json
+import tempfile
+import pandas as pd
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from . import schemas
+from .config import settings
+
+# Размер блока при копировании загрузки на диск
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+# Расширения временных файлов для загружаемых форматов
+FILE_SUFFIXES = {
+    "csv": ".csv",
+    "excel": ".xlsx",
+    "ndjson": ".ndjson",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+
+async def save_upload(file: UploadFile, suffix: str, directory: str = None) -> str:
+    """Сохраняет загружаемый файл во временный файл на диске блоками"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=directory) as temp_file:
+        while True:
+            block = await file.read(UPLOAD_BUFFER_SIZE)
+            if not block:
+                break
+            await run_in_threadpool(temp_file.write, block)
+    return temp_file.name
+
+
+def _read_csv_chunks(path: str, chunk_rows: int):
+    """Читает CSV порциями средствами pandas"""
+    yield from pd.read_csv(path, chunksize=chunk_rows)
+
+
+def _read_excel_chunks(path: str, chunk_rows: int):
+    """Читает первый лист Excel построчно (read-only режим openpyxl)"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(column) for column in header]
+        batch = []
+        for row in rows:
+            if all(cell is None for cell in row):
+                continue
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+
+# Значения по умолчанию необязательных полей элемента
+FIELD_DEFAULTS = {
+    name: field.default
+    for name, field in schemas.TestItemBase.model_fields.items()
+    if not field.is_required()
+}
+
+
+def _read_ndjson_chunks(path: str, chunk_rows: int):
+    """Читает JSON по строке на запись порциями.
+
+    Отсутствующий ключ получает значение по умолчанию из схемы, а явный
+    null остается пропуском и отклоняется проверкой, как в pydantic;
+    pandas.read_json эти случаи не различает.
+    """
+    with open(path, encoding="utf-8") as source:
+        batch = []
+        for line in source:
+            if not line.strip():
+                continue
+            batch.append({**FIELD_DEFAULTS, **json.loads(line)})
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame.from_records(batch)
+                batch = []
+        if batch:
+            yield pd.DataFrame.from_records(batch)
+
+
+def _read_parquet_chunks(path: str, chunk_rows: int):
+    """Читает Parquet пакетами строк, не загружая файл целиком"""
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    try:
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    finally:
+        parquet_file.close()
+
+
+def _read_arrow_chunks(path: str, chunk_rows: int):
+    """Читает Arrow IPC (файловый или потоковый формат) пакетами строк"""
+    import pyarrow as pa
+
+    with pa.memory_map(path) as source:
+        try:
+            file_reader = pa.ipc.open_file(source)
+            batches = (file_reader.get_batch(i) for i in range(file_reader.num_record_batches))
+        except pa.ArrowInvalid:
+            source.seek(0)
+            batches = pa.ipc.open_stream(source)
+        for batch in batches:
+            for offset in range(0, batch.num_rows, chunk_rows):
+                yield batch.slice(offset, chunk_rows).to_pandas()
+
+
+# Читатели порций по формату файла
+CHUNK_READERS = {
+    "csv": _read_csv_chunks,
+    "excel": _read_excel_chunks,
+    "ndjson": _read_ndjson_chunks,
+    "parquet": _read_parquet_chunks,
+    "arrow": _read_arrow_chunks,
+}
+
+
+async def iter_chunks(path: str, file_format: str, chunk_rows: int = None):
+    """Асинхронно отдает порции файла (DataFrame), выполняя разбор в пуле потоков"""
+    reader = CHUNK_READERS[file_format](path, chunk_rows or settings.UPLOAD_CHUNK_ROWS)
+    async for chunk in iterate_in_threadpool(reader):
+        yield chunk
@@ -0,0 +1,113 @@
+"""
+Запуск api_service в нескольких процессах.
+
+Миграции схемы выполняются один раз в этом процессе до запуска
+воркеров, сами воркеры стартуют с SCHEMA_INIT_ON_STARTUP=false.
+Число воркеров берется из WEB_CONCURRENCY или числа CPU, а пул
+подключений каждого воркера — из общего лимита DB_MAX_CONNECTIONS.
+
+Несколько воркеров запускаются только с общим хранилищем кэша
+(CACHE_BACKEND=redis) или без кэша: в памяти процесса инвалидация
+кэша ответов не видна другим воркерам. Задания импорта и ключи
+идемпотентности хранятся в БД, файлы импорта — в общем IMPORT_DIR.
+
+    cd api_service
+    python -m app.launcher --workers 4
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+
+def worker_count(requested: int = 0) -> int:
+    """Число воркеров: явное значение или по одному на CPU (асинхронные воркеры)"""
+    return requested if requested > 0 else max(1, os.cpu_count() or 1)
+
+
+def check_shared_state(workers: int, cache_backend: str):
+    """Отказывает в запуске нескольких воркеров с состоянием в памяти процесса"""
+    if workers > 1 and cache_backend == "memory":
+        raise SystemExit(
+            f"{workers} workers need a shared cache: set CACHE_BACKEND=redis (or none) or run with --workers 1"
+        )
+
+
+def pool_limits(workers: int, max_connections: int, pool_size: int, max_overflow: int) -> tuple[int, int]:
+    """Размер пула и overflow одного воркера в рамках общего лимита подключений к БД.
+
+    Гарантирует workers * (pool_size + max_overflow) <= max_connections.
+    Лимит действует на каждый сервер БД: основная база и каждая реплика
+    получают пулы этого размера из тех же DB_POOL_SIZE/DB_MAX_OVERFLOW.
+    """
+    if max_connections <= 0:
+        return pool_size, max_overflow
+    per_worker = max_connections // workers
+    if per_worker < 1:
+        raise SystemExit(f"DB_MAX_CONNECTIONS={max_connections} is less than the number of workers ({workers})")
+    size = min(pool_size, per_worker)
+    return size, min(max_overflow, per_worker - size)
+
+
+async def _migrate() -> float:
+    from .database import engine
+    from .migrations import run_migrations
+
+    started = time.perf_counter()
+    try:
+        await run_migrations(engine)
+    finally:
+        # Подключения не должны переходить в дочерние процессы
+        await engine.dispose()
+    return time.perf_counter() - started
+
+
+def _unload_app_modules():
+    """Выгружает уже импортированные модули приложения.
+
+    С одним воркером uvicorn запускает приложение в этом процессе, и без
+    выгрузки app.main получил бы настройки и движок, созданные до
+    обновления окружения (миграции при старте, пул без лимита).
+    """
+    package = __package__ or "app"
+    for name in [name for name in sys.modules if name == package or name.startswith(package + ".")]:
+        del sys.modules[name]
+
+
+def main(argv=None):
+    from .config import settings
+
+    parser = argparse.ArgumentParser(description="Run api_service with multiple workers")
+    parser.add_argument("--host", default=settings.HOST)
+    parser.add_argument("--port", type=int, default=settings.PORT)
+    parser.add_argument("--workers", type=int, default=settings.WEB_CONCURRENCY)
+    parser.add_argument("--skip-migrations", action="store_true", help="Schema is managed elsewhere")
+    args = parser.parse_args(argv)
+
+    launched_at = time.time()
+    workers = worker_count(args.workers)
+    check_shared_state(workers, settings.CACHE_BACKEND)
+    pool_size, max_overflow = pool_limits(workers, settings.DB_MAX_CONNECTIONS,
+                                          settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+
+    if not args.skip_migrations:
+        print(f"Migrations applied in {asyncio.run(_migrate()) * 1000:.1f} ms")
+
+    # Настройки воркеров передаются через окружение: воркеры импортируют приложение заново
+    os.environ.update({
+        "SCHEMA_INIT_ON_STARTUP": "false",
+        "DB_POOL_SIZE": str(pool_size),
+        "DB_MAX_OVERFLOW": str(max_overflow),
+        "API_LAUNCHED_AT": str(launched_at),
+    })
+    print(f"Starting {workers} workers, DB pool {pool_size}+{max_overflow} per worker and database server")
+    _unload_app_modules()
+
+    import uvicorn
+    uvicorn.run("app.main:app", host=args.host, port=args.port, workers=workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,24 @@
 """
 
 
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query
-from . import schemas, crud, dependencies
-from .database import get_db, engine, Base
-from .auth import create_refresh_token
-from .models import TestTable
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query, Request, Response, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from . import schemas, crud, dependencies, ingest, pagination, search, indexes, cache, sweeper, export, validation, streaming
+from . import idempotency, migrations, aggregates
+from .cache import response_cache
+from .metrics import request_metrics, instrument_engine, MetricsMiddleware
+from .imports import import_manager
+from .config import settings
+from .database import get_db, engine, replica_engines, pool_stats, request_bind, ReplicaStickinessMiddleware
+from .auth import create_refresh_token, password_hasher, token_cache
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
 from datetime import datetime, timedelta
-import pandas as pd
-from pydantic import ValidationError
-import tempfile
+from pydantic import TypeAdapter
+from typing import Union
 import os
+import time
 
 app = FastAPI(
     title="Enhanced FastAPI Application",
@@ -22,31 +29,69 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Длительность запросов и SQL-активность по маршрутам
+app.add_middleware(MetricsMiddleware, metrics=request_metrics)
+
+# Закрепление чтений клиента за основной БД сразу после его записи
+app.add_middleware(ReplicaStickinessMiddleware)
+
+# SQLSTATE нарушения уникального ограничения в PostgreSQL
+UNIQUE_VIOLATION = "23505"
+
+def _is_unique_violation(exc: IntegrityError) -> bool:
+    orig = exc.orig
+    code = getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)
+    if code:
+        return code == UNIQUE_VIOLATION
+    # SQLite не сообщает SQLSTATE, вид ограничения есть только в тексте ошибки
+    return "UNIQUE constraint failed" in str(orig)
+
+# Нарушение уникальности (например, ключа UPSERT_KEY при обычной вставке);
+# прочие нарушения ограничений (NOT NULL, внешние ключи) остаются ошибкой сервера
+@app.exception_handler(IntegrityError)
+async def integrity_error_handler(request: Request, exc: IntegrityError):
+    if not _is_unique_violation(exc):
+        raise exc
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": "Row conflicts with existing data"}
+    )
+
+# Сериализаторы ответов, которые кэшируются в готовом JSON
+ITEM = TypeAdapter(schemas.TestItemResponse)
+ITEM_LIST = TypeAdapter(list[schemas.TestItemResponse])
+COMMENT_LIST = TypeAdapter(list[schemas.CommentResponse])
+ITEM_WITH_COMMENTS_LIST = TypeAdapter(list[schemas.TestItemWithComments])
+ITEM_STATS = TypeAdapter(list[schemas.ItemValueStats])
+
+def _dump_json(adapter: TypeAdapter, value) -> bytes:
+    """Сериализует ORM-объекты через схему ответа"""
+    return adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+
+def _stream_json(request: Request, build_query, schema) -> StreamingResponse:
+    """Потоковый JSON-массив без кэша и курсора следующей страницы (заголовки уходят до строк)"""
+    return StreamingResponse(streaming.json_array(build_query, schema, request_bind(request)),
+                             media_type="application/json")
+
 # Регистрация пользователя
 @app.post("/register", response_model=schemas.Token)
 async def register(
         user: schemas.UserCreate,
         db: AsyncSession = Depends(get_db)
 ):
-    """Регистрация нового пользователя"""
-    existing_user = await crud.get_user(db, user.username)
-    if existing_user:
+    """Регистрация нового пользователя (первый пользователь становится администратором)"""
+    db_user = await crud.create_user_if_absent(db, schemas.UserCreate(
+        username=user.username,
+        password=user.password
+    ))
+    if not db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered"
         )
 
-    users = await crud.get_users(db)
-    role = "admin" if len(users) == 0 else "user"
-
-    db_user = await crud.create_user(db, schemas.UserCreate(
-        username=user.username,
-        password=user.password,
-        role=role
-    ))
-
     access_token = crud.auth.create_access_token(
-        data={"sub": user.username, "role": role}
+        data={"sub": user.username, "role": db_user.role}
     )
     refresh_token = create_refresh_token(
         data={"sub": user.username}
@@ -67,7 +112,7 @@ async def login(
 ):
     """Аутентификация пользователя"""
     db_user = await crud.get_user(db, user.username)
-    if not db_user or not crud.auth.verify_password(user.password, db_user.hashed_password):
+    if not db_user or not await crud.auth.verify_password(user.password, db_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials"
@@ -101,46 +146,48 @@ async def refresh_access_token(
             detail="Invalid refresh token"
         )
 
-    db_token = await crud.get_refresh_token(db, refresh_token.refresh_token)
-    if not db_token or db_token.expires_at < datetime.utcnow():
+    # Старый токен заменяется новым одним UPDATE, без удаления и вставки
+    new_refresh_token = create_refresh_token(
+        data={"sub": payload["sub"]}
+    )
+    user = await crud.rotate_refresh_token(
+        db,
+        refresh_token.refresh_token,
+        new_refresh_token,
+        expires_at=datetime.utcnow() + timedelta(days=7),
+        username=payload["sub"]
+    )
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Refresh token expired or invalid"
         )
 
-    user = await crud.get_user(db, payload["sub"])
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-
-    await crud.delete_refresh_token(db, refresh_token.refresh_token)
-
     access_token = crud.auth.create_access_token(
         data={"sub": user.username, "role": user.role}
     )
-    new_refresh_token = create_refresh_token(
-        data={"sub": user.username}
-    )
-    await crud.create_refresh_token(
-        db,
-        user_id=user.id,
-        token=new_refresh_token,
-        expires_at=datetime.utcnow() + timedelta(days=7)
-    )
     return {"access_token": access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
 
 # Получение списка пользователей (admin)
 @app.get("/users/", response_model=list[schemas.UserResponse])
 async def read_users(
+        request: Request,
+        response: Response,
         skip: int = 0,
         limit: int = 100,
+        cursor: str = Query(None, description="Opaque cursor from the X-Next-Cursor header"),
+        stream: bool = Query(False, description="Stream the JSON array from a server-side cursor"),
         db: AsyncSession = Depends(get_db),
         admin: dict = Depends(dependencies.require_admin)
 ):
     """Получение списка пользователей (только для администраторов)"""
-    return await crud.get_users(db, skip=skip, limit=limit)
+    after_id = pagination.cursor_id(cursor)
+    if stream:
+        return _stream_json(request, lambda _: crud.users_page_query(skip=skip, limit=limit, after_id=after_id),
+                            schemas.UserResponse)
+    users = await crud.get_users(db, skip=skip, limit=limit, after_id=after_id)
+    pagination.set_next_cursor(response, users, limit)
+    return users
 
 # Получение информации о пользователе
 @app.get("/users/{username}", response_model=schemas.UserResponse)
@@ -212,11 +259,9 @@ async def logout(
 # Информация о текущем пользователе
 @app.get("/me", response_model=schemas.UserResponse)
 async def read_current_user(
-        current_user: dict = Depends(dependencies.get_current_user),
-        db: AsyncSession = Depends(get_db)
+        user=Depends(dependencies.get_current_db_user)
 ):
     """Получение информации о текущем пользователе"""
-    user = await crud.get_user(db, current_user["username"])
     return user
 
 # Обновление текущего пользователя
@@ -228,6 +273,11 @@ async def update_current_user(
 ):
     """Обновление информации о текущем пользователе"""
     updated_user = await crud.update_user(db, current_user["username"], user_update)
+    if not updated_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
     return updated_user
 
 # Удаление текущего пользователя
@@ -253,122 +303,321 @@ async def create_item(
 @app.post("/batch-items/", response_model=list[schemas.TestItemResponse], status_code=status.HTTP_201_CREATED)
 async def create_batch_items(
     items: list[schemas.TestItemCreate],
+    mode: str = Query("insert", pattern="^(insert|upsert)$", description="upsert: update rows matching UPSERT_KEY"),
+    idempotency_key: str = Header(None, alias=idempotency.IDEMPOTENCY_HEADER, max_length=255),
     db: AsyncSession = Depends(get_db),
-    _=Depends(dependencies.require_user)
-):
-    db_items = [TestTable(**item.dict()) for item in items]
-    db.add_all(db_items)
-    await db.commit()
-    for db_item in db_items:
-        await db.refresh(db_item)
-    return db_items
-
-# Загрузка данных из CSV
-@app.post("/upload-csv/", response_model=list[schemas.TestItemResponse], status_code=status.HTTP_201_CREATED)
-async def upload_csv(
-    file: UploadFile = File(...),
-    db: AsyncSession = Depends(get_db),
-    _=Depends(dependencies.require_user)
+    current_user: dict = Depends(dependencies.require_user)
 ):
+    """Пакетная вставка; повтор с тем же Idempotency-Key возвращает сохраненный ответ"""
+    if mode == "upsert" and not indexes.upsert_index_ready:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Upsert is not available: UPSERT_KEY is not configured or its unique index is missing"
+        )
+    if not idempotency_key:
+        return await _write_batch(db, items, mode)
+
+    owner = current_user["username"]
+    request_fingerprint = idempotency.fingerprint({"mode": mode, "items": [item.dict() for item in items]})
+    replayed = await idempotency.begin(owner, idempotency_key, request_fingerprint)
+    if replayed:
+        return replayed
     try:
-        # Сохраняем файл во временный файл на диске
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
-
-        # Читаем CSV из временного файла
-        df = pd.read_csv(temp_file_path)
-        items = df.to_dict(orient='records')
-        validated_items = []
-        for item in items:
-            validated_item = schemas.TestItemCreate(**item)
-            validated_items.append(validated_item)
-        db_items = [TestTable(**item.dict()) for item in validated_items]
-        db.add_all(db_items)
-        await db.commit()
-        for db_item in db_items:
-            await db.refresh(db_item)
+        body = _dump_json(ITEM_LIST, await _write_batch(db, items, mode))
+    except Exception:
+        # Транзакция запроса завершается до снятия резерва, иначе она удерживает блокировки
+        await db.rollback()
+        await idempotency.release(owner, idempotency_key)
+        raise
+    await idempotency.remember(owner, idempotency_key, body, status.HTTP_201_CREATED)
+    return Response(content=body, status_code=status.HTTP_201_CREATED, media_type="application/json")
+
+async def _write_batch(db: AsyncSession, items: list, mode: str):
+    """Вставляет или обновляет пакет элементов в зависимости от режима"""
+    if mode == "upsert":
+        return await crud.upsert_test_items(db, items, indexes.UPSERT_KEY_COLUMNS)
+    return await crud.bulk_create_test_items(db, items)
+
+async def _ingest_upload(file: UploadFile, file_format: str, label: str, db: AsyncSession, stream: bool):
+    """Читает загруженный файл порциями, проверяет и сохраняет строки.
+
+    В потоковом режиме каждая порция фиксируется отдельной транзакцией и в ответ
+    возвращается только сводка, поэтому потребление памяти не растет с размером файла.
+    """
+    temp_file_path = None
+    rows_inserted = 0
+    chunks = 0
+    report = validation.ValidationReport()
+    try:
+        # Сохраняем файл во временный файл на диске блоками
+        temp_file_path = await ingest.save_upload(file, suffix=ingest.FILE_SUFFIXES[file_format])
+
+        db_items = []
+        async for frame in ingest.iter_chunks(temp_file_path, file_format):
+            valid_rows = report.check(frame)
+            # После первой ошибки файл только проверяется до конца, чтобы вернуть все ошибки
+            if not report.failed:
+                if stream:
+                    rows_inserted += await crud.insert_test_items(db, valid_rows)
+                else:
+                    db_items.extend(await crud.bulk_create_test_items(db, valid_rows, commit=False))
+            chunks += 1
+
+        if report.failed:
+            raise validation.TableValidationError(report)
+
+        if stream:
+            return schemas.UploadSummary(rows_inserted=rows_inserted, chunks=chunks)
 
-        # Удаляем временный файл
-        os.remove(temp_file_path)
+        await db.commit()
+        await response_cache.invalidate("items", "items_comments")
         return db_items
-    except ValidationError as e:
+    except validation.TableValidationError:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Validation error in CSV data: {str(e)}"
+            detail={
+                "message": f"Validation error in {label} data",
+                "rows_inserted": rows_inserted,
+                "rows_rejected": report.rows_rejected,
+                "invalid_rows": report.invalid_rows,
+                "errors": report.errors,
+            }
         )
     except Exception as e:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Error processing CSV file: {str(e)}"
+            detail=f"Error processing {label} file: {str(e)}"
         )
+    finally:
+        # Удаляем временный файл
+        if temp_file_path:
+            os.remove(temp_file_path)
+
+# Загрузка данных из CSV
+@app.post(
+    "/upload-csv/",
+    response_model=Union[list[schemas.TestItemResponse], schemas.UploadSummary],
+    status_code=status.HTTP_201_CREATED
+)
+async def upload_csv(
+    file: UploadFile = File(...),
+    stream: bool = Query(False, description="Chunked ingest: commit per chunk and return a summary"),
+    db: AsyncSession = Depends(get_db),
+    _=Depends(dependencies.require_user)
+):
+    return await _ingest_upload(file, "csv", "CSV", db, stream)
 
 # Загрузка данных из Excel
-@app.post("/upload-excel/", response_model=list[schemas.TestItemResponse], status_code=status.HTTP_201_CREATED)
+@app.post(
+    "/upload-excel/",
+    response_model=Union[list[schemas.TestItemResponse], schemas.UploadSummary],
+    status_code=status.HTTP_201_CREATED
+)
 async def upload_excel(
     file: UploadFile = File(...),
+    stream: bool = Query(False, description="Chunked ingest: commit per chunk and return a summary"),
     db: AsyncSession = Depends(get_db),
     _=Depends(dependencies.require_user)
 ):
-    try:
-        # Сохраняем файл во временный файл на диске
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
-
-        # Читаем Excel из временного файла
-        df = pd.read_excel(temp_file_path)
-        items = df.to_dict(orient='records')
-        validated_items = []
-        for item in items:
-            validated_item = schemas.TestItemCreate(**item)
-            validated_items.append(validated_item)
-        db_items = [TestTable(**item.dict()) for item in validated_items]
-        db.add_all(db_items)
-        await db.commit()
-        for db_item in db_items:
-            await db.refresh(db_item)
+    return await _ingest_upload(file, "excel", "Excel", db, stream)
 
-        # Удаляем временный файл
-        os.remove(temp_file_path)
-        return db_items
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Validation error in Excel data: {str(e)}"
-        )
-    except Exception as e:
+# Загрузка данных из NDJSON (одна JSON-запись на строку)
+@app.post(
+    "/upload-ndjson/",
+    response_model=Union[list[schemas.TestItemResponse], schemas.UploadSummary],
+    status_code=status.HTTP_201_CREATED
+)
+async def upload_ndjson(
+    file: UploadFile = File(...),
+    stream: bool = Query(False, description="Chunked ingest: commit per chunk and return a summary"),
+    db: AsyncSession = Depends(get_db),
+    _=Depends(dependencies.require_user)
+):
+    return await _ingest_upload(file, "ndjson", "NDJSON", db, stream)
+
+# Загрузка данных из Parquet
+@app.post(
+    "/upload-parquet/",
+    response_model=Union[list[schemas.TestItemResponse], schemas.UploadSummary],
+    status_code=status.HTTP_201_CREATED
+)
+async def upload_parquet(
+    file: UploadFile = File(...),
+    stream: bool = Query(False, description="Chunked ingest: commit per chunk and return a summary"),
+    db: AsyncSession = Depends(get_db),
+    _=Depends(dependencies.require_user)
+):
+    return await _ingest_upload(file, "parquet", "Parquet", db, stream)
+
+# Загрузка данных из Arrow IPC
+@app.post(
+    "/upload-arrow/",
+    response_model=Union[list[schemas.TestItemResponse], schemas.UploadSummary],
+    status_code=status.HTTP_201_CREATED
+)
+async def upload_arrow(
+    file: UploadFile = File(...),
+    stream: bool = Query(False, description="Chunked ingest: commit per chunk and return a summary"),
+    db: AsyncSession = Depends(get_db),
+    _=Depends(dependencies.require_user)
+):
+    return await _ingest_upload(file, "arrow", "Arrow", db, stream)
+
+# Потоковая выгрузка тестовых элементов
+@app.get("/export/items")
+async def export_items(
+    request: Request,
+    file_format: str = Query("ndjson", pattern="^(ndjson|csv|parquet)$", description="Export format"),
+    name: str = Query(None, description="Filter by name (partial match)"),
+    value_min: int = Query(None, description="Minimum value filter"),
+    value_max: int = Query(None, description="Maximum value filter"),
+    _=Depends(dependencies.require_user)
+):
+    """Выгрузка всех подходящих элементов пакетами без загрузки результата в память"""
+    return StreamingResponse(
+        export.export_items(file_format, request_bind(request), name=name, value_min=value_min, value_max=value_max),
+        media_type=export.MEDIA_TYPES[file_format],
+        headers={"Content-Disposition": f'attachment; filename="items.{file_format}"'}
+    )
+
+# Фоновый импорт файла
+@app.post("/imports/", response_model=schemas.ImportJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_import(
+    response: Response,
+    file: UploadFile = File(...),
+    file_format: str = Query("csv", description="Upload format: csv, excel, ndjson, parquet or arrow"),
+    current_user: dict = Depends(dependencies.require_user)
+):
+    """Сохранение файла и постановка его в очередь импорта; ход выполнения — в /imports/{job_id}"""
+    if file_format not in ingest.FILE_SUFFIXES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Error processing Excel file: {str(e)}"
+            detail=f"Unsupported file format: {file_format}"
         )
+    job = await import_manager.submit(file, file_format, ingest.FILE_SUFFIXES[file_format], current_user["username"])
+    response.headers["Location"] = f"/imports/{job.id}"
+    return job
+
+# Состояние фонового импорта
+@app.get("/imports/{job_id}", response_model=schemas.ImportJobResponse)
+async def read_import(
+    job_id: str,
+    current_user: dict = Depends(dependencies.require_user)
+):
+    """Прогресс задания импорта: обработанные и отклоненные строки, скорость"""
+    job = await import_manager.get(job_id)
+    if not job or (current_user["role"] != "admin" and job.owner != current_user["username"]):
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
 
 # Получение списка тестовых элементов с фильтрацией
-@app.get("/items/", response_model=list[schemas.TestItemResponse])
+@app.get("/items/", response_model=Union[list[schemas.TestItemResponse], list[schemas.TestItemWithComments]])
 async def read_items(
+    request: Request,
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, description="Opaque cursor from the X-Next-Cursor header"),
+    name: str = Query(None, description="Filter by name (partial match)"),
+    value_min: int = Query(None, description="Minimum value filter"),
+    value_max: int = Query(None, description="Maximum value filter"),
+    search_mode: str = Query("substring", pattern=search.SEARCH_MODE_PATTERN, description="Name match: substring or trigram similarity"),
+    rank: bool = Query(False, description="Order name matches by similarity"),
+    stream: bool = Query(False, description="Stream the JSON array from a server-side cursor"),
+    include: str = Query(None, pattern="^comments$", description="Embed related rows: comments"),
+    comments_limit: int = Query(20, ge=0, le=100, description="Comments per item with include=comments"),
+    db: AsyncSession = Depends(get_db),
+    _=Depends(dependencies.require_user)
+):
+    ranked = rank and bool(name)
+    if ranked and cursor is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor pagination is not supported for ranked search, use skip"
+        )
+    after_id = pagination.cursor_id(cursor)
+
+    filters = dict(skip=skip, limit=limit, name=name, value_min=value_min, value_max=value_max,
+                   after_id=after_id, search_mode=search_mode, rank=ranked)
+
+    if include == "comments":
+        async def load_with_comments():
+            items = await crud.get_test_items_with_comments(db, comments_limit=comments_limit, **filters)
+            headers = {} if ranked else pagination.next_cursor_headers(items, limit)
+            return cache.pack_response(_dump_json(ITEM_WITH_COMMENTS_LIST, items), headers)
+
+        value = await cache.load_cached(request, "items_comments", cache.request_key(request), load_with_comments)
+        return cache.json_response(request, value)
+
+    if stream:
+        return _stream_json(
+            request,
+            lambda stream_db: crud.test_items_page_query(
+                stream_db, skip=skip, limit=limit, after_id=after_id, name=name, value_min=value_min,
+                value_max=value_max, search_mode=search_mode, rank=ranked),
+            schemas.TestItemResponse
+        )
+
+    async def load():
+        items = await crud.get_test_items(db, **filters)
+        headers = {} if ranked else pagination.next_cursor_headers(items, limit)
+        return cache.pack_response(_dump_json(ITEM_LIST, items), headers)
+
+    return cache.json_response(request, await cache.load_cached(request, "items", cache.request_key(request), load))
+
+# Статистика значений тестовых элементов (объявлена до /items/{item_id})
+@app.get("/items/stats", response_model=list[schemas.ItemValueStats])
+async def read_item_stats(
+    request: Request,
     name: str = Query(None, description="Filter by name (partial match)"),
     value_min: int = Query(None, description="Minimum value filter"),
     value_max: int = Query(None, description="Maximum value filter"),
+    search_mode: str = Query("substring", pattern=search.SEARCH_MODE_PATTERN, description="Name match: substring or trigram similarity"),
+    group_prefix: int = Query(None, ge=1, le=100, description="Group by the first N characters of the name"),
+    bins: int = Query(10, ge=1, le=100, description="Histogram buckets"),
+    source: str = Query("live", pattern="^(live|summary)$", description="live rows or the trigger-maintained value summary"),
     db: AsyncSession = Depends(get_db),
     _=Depends(dependencies.require_user)
 ):
-    return await crud.get_test_items(db, skip=skip, limit=limit, name=name, value_min=value_min, value_max=value_max)
+    """Количество, минимум, максимум, среднее, процентили и гистограмма value одним SQL-запросом"""
+    if source == "summary":
+        if name or group_prefix:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The value summary supports only value_min and value_max filters"
+            )
+        if not aggregates.summary_available(db):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The value summary is not available for this database"
+            )
+
+    async def load():
+        stats = await aggregates.item_value_stats(
+            db, bins=bins, prefix_length=group_prefix, source=source,
+            name=name, value_min=value_min, value_max=value_max, search_mode=search_mode
+        )
+        return cache.pack_response(ITEM_STATS.dump_json(ITEM_STATS.validate_python(stats)))
+
+    return cache.json_response(request, await cache.load_cached(request, "items", cache.request_key(request), load))
 
 # Получение одного тестового элемента
 @app.get("/items/{item_id}", response_model=schemas.TestItemResponse)
 async def read_item(
         item_id: int,
+        request: Request,
         db: AsyncSession = Depends(get_db),
         _=Depends(dependencies.require_user)
 ):
-    item = await crud.get_test_item(db, item_id)
-    if not item:
+    async def load():
+        item = await crud.get_test_item(db, item_id)
+        return cache.pack_response(_dump_json(ITEM, item)) if item else None
+
+    value = await cache.load_cached(request, f"item:{item_id}", "", load)
+    if value is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    return item
+    return cache.json_response(request, value)
 
 # Обновление тестового элемента
 @app.patch("/items/{item_id}", response_model=schemas.TestItemResponse)
@@ -403,22 +652,34 @@ async def create_comment(
         current_user: dict = Depends(dependencies.require_user)
 ):
     """Добавление комментария к тестовому элементу"""
-    item = await crud.get_test_item(db, item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
     db_comment = await crud.create_comment(db, item_id, comment, current_user["username"])
+    if not db_comment:
+        raise HTTPException(status_code=404, detail="Item not found")
     return db_comment
 
 # Получение комментариев
 @app.get("/items/{item_id}/comments", response_model=list[schemas.CommentResponse])
 async def read_comments(
         item_id: int,
+        request: Request,
+        limit: int = Query(100, ge=1, le=1000),
+        cursor: str = Query(None, description="Opaque cursor from the X-Next-Cursor header"),
+        stream: bool = Query(False, description="Stream the JSON array from a server-side cursor"),
         db: AsyncSession = Depends(get_db),
         _=Depends(dependencies.require_user)
 ):
-    """Получение комментариев к тестовому элементу"""
-    comments = await crud.get_comments(db, item_id)
-    return comments
+    """Получение комментариев к тестовому элементу в порядке создания"""
+    after = pagination.cursor_created_at(cursor)
+    if stream:
+        return _stream_json(request, lambda _: crud.comments_query(item_id, limit=limit, after=after), schemas.CommentResponse)
+
+    async def load():
+        comments = await crud.get_comments(db, item_id, limit=limit, after=after)
+        headers = pagination.next_cursor_headers(comments, limit, pagination.created_at_key)
+        return cache.pack_response(_dump_json(COMMENT_LIST, comments), headers)
+
+    value = await cache.load_cached(request, f"comments:{item_id}", cache.request_key(request), load)
+    return cache.json_response(request, value)
 
 # Удаление комментария
 @app.delete("/items/{item_id}/comments/{comment_id}")
@@ -434,13 +695,71 @@ async def delete_comment(
         raise HTTPException(status_code=404, detail="Comment not found")
     if current_user["role"] != "admin" and comment.author != current_user["username"]:
         raise HTTPException(status_code=403, detail="Not authorized to delete this comment")
-    await crud.delete_comment(db, comment_id)
+    await crud.delete_comment(db, comment_id, item_id)
     return {"message": "Comment deleted successfully"}
 
+def _internal_stats() -> dict:
+    return {
+        "password_hasher": password_hasher.stats(),
+        "token_cache": token_cache.stats(),
+        "db_pool": pool_stats(engine),
+        "db_replica_pools": [pool_stats(replica) for replica in replica_engines],
+        "response_cache": response_cache.stats(),
+        "startup": getattr(app.state, "startup", {}),
+    }
+
+# Состояние внутренних пулов (admin)
+@app.get("/stats")
+async def read_stats(admin: dict = Depends(dependencies.require_admin)):
+    """Метрики внутренних подсистем (только для администраторов)"""
+    return _internal_stats()
+
+# Метрики для Prometheus
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics(_: dict = Depends(dependencies.require_metrics_access)):
+    """Гистограммы запросов, SQL по маршрутам и счетчики внутренних подсистем"""
+    return PlainTextResponse(request_metrics.render(_internal_stats()), media_type="text/plain; version=0.0.4")
+
+for bound_engine in (engine, *replica_engines):
+    # Функции поиска для SQLite регистрируются на каждом новом подключении
+    search.register_sqlite_functions(bound_engine)
+    # Учет SQL-запросов и времени БД для метрик
+    instrument_engine(bound_engine, request_metrics)
+
 # Создание таблиц при запуске
 @app.on_event("startup")
 async def startup_event():
-    """Создание таблиц при запуске приложения"""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    print("Database tables created")
\ No newline at end of file
+    """Миграции схемы (если их не выполнил app.launcher) и запуск фоновых задач"""
+    started = time.perf_counter()
+    if settings.SCHEMA_INIT_ON_STARTUP:
+        await migrations.run_migrations(engine)
+        print("Database tables created")
+    else:
+        async with engine.connect() as conn:
+            await conn.run_sync(indexes.ensure_upsert_index, False)
+
+    # Фоновая очистка истекших refresh-токенов
+    if settings.REFRESH_TOKEN_SWEEP_INTERVAL > 0:
+        app.state.token_sweeper = asyncio.create_task(sweeper.run_refresh_token_sweeper())
+
+    # Воркеры фонового импорта
+    await import_manager.start()
+
+    # Холодный старт: от запуска launcher (если он есть) до готовности воркера
+    app.state.startup = {"startup_seconds": round(time.perf_counter() - started, 4)}
+    launched_at = os.getenv("API_LAUNCHED_AT")
+    if launched_at:
+        app.state.startup["cold_start_seconds"] = round(time.time() - float(launched_at), 4)
+    print(f"Worker {os.getpid()} ready: {app.state.startup}")
+
+# Освобождение ресурсов при остановке
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка фоновых задач и пула хеширования паролей"""
+    token_sweeper = getattr(app.state, "token_sweeper", None)
+    if token_sweeper:
+        token_sweeper.cancel()
+        # Дожидаемся отмены, чтобы прерванная очистка вернула подключение в пул
+        await asyncio.gather(token_sweeper, return_exceptions=True)
+    await import_manager.stop()
+    password_hasher.shutdown()
@@ -0,0 +1,197 @@
+"""
+Файл содержит сбор метрик запросов: гистограммы длительности по
+маршрутам, число SQL-запросов и время БД на каждый HTTP-запрос
+(через события движка SQLAlchemy), вывод в формате Prometheus и
+журналирование медленных запросов вместе с их SQL.
+"""
+
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from sqlalchemy import event
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы длительности запроса, секунды
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Сколько SQL-запросов одного HTTP-запроса хранить для журнала медленных запросов
+MAX_LOGGED_STATEMENTS = 50
+
+
+@dataclass
+class RequestStats:
+    """SQL-активность одного HTTP-запроса"""
+    statements: int = 0
+    db_seconds: float = 0.0
+    log: list = field(default_factory=list)
+
+
+# Статистика текущего запроса; None вне HTTP-запроса (фоновые задачи)
+_current = ContextVar("request_db_stats", default=None)
+
+
+class MetricsMiddleware:
+    """ASGI-middleware метрик запросов.
+
+    Запрос учитывается после отправки всего тела ответа, поэтому
+    длительность и SQL потоковых ответов (экспорт, stream=true)
+    включают работу генератора, а не только обработчика.
+    """
+
+    def __init__(self, app, metrics: "RequestMetrics"):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = self.metrics.begin()
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            self.metrics.observe(scope["method"], route.path if route else "<unmatched>", status_code,
+                                 time.perf_counter() - started, stats)
+
+
+class Histogram:
+    """Кумулятивная гистограмма Prometheus с фиксированными корзинами"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+class RequestMetrics:
+    """Метрики HTTP-запросов и SQL по маршрутам"""
+
+    def __init__(self):
+        self.durations = {}
+        self.requests = {}
+        self.db_statements = {}
+        self.db_seconds = {}
+        self.statements_total = 0
+        self.db_seconds_total = 0.0
+
+    def begin(self) -> RequestStats:
+        stats = RequestStats()
+        _current.set(stats)
+        return stats
+
+    def record_statement(self, statement: str, seconds: float):
+        self.statements_total += 1
+        self.db_seconds_total += seconds
+        stats = _current.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += seconds
+            if len(stats.log) < MAX_LOGGED_STATEMENTS:
+                stats.log.append((seconds, statement))
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        self.durations.setdefault(key, Histogram()).observe(seconds)
+        status_key = (method, route, str(status_code))
+        self.requests[status_key] = self.requests.get(status_key, 0) + 1
+        self.db_statements[key] = self.db_statements.get(key, 0) + stats.statements
+        self.db_seconds[key] = self.db_seconds.get(key, 0.0) + stats.db_seconds
+        if settings.SLOW_REQUEST_MS and seconds * 1000 >= settings.SLOW_REQUEST_MS:
+            self._log_slow(method, route, status_code, seconds, stats)
+
+    def _log_slow(self, method: str, route: str, status_code: int, seconds: float, stats: RequestStats):
+        statements = "\n".join(f"  {duration * 1000:.1f} ms: {sql}" for duration, sql in stats.log)
+        logger.warning(
+            "Slow request %s %s -> %d: %.1f ms, %d SQL statements, %.1f ms in DB\n%s",
+            method, route, status_code, seconds * 1000, stats.statements, stats.db_seconds * 1000, statements
+        )
+
+    def render(self, gauges: dict = None) -> str:
+        """Метрики в текстовом формате Prometheus; gauges — вложенные словари stats()"""
+        lines = [
+            "# HELP http_request_duration_seconds HTTP request latency by route",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), histogram in sorted(self.durations.items()):
+            labels = f'method="{method}",route="{_escape(route)}"'
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {histogram.count}")
+
+        lines += ["# HELP http_requests_total HTTP requests by route and status", "# TYPE http_requests_total counter"]
+        for (method, route, status_code), count in sorted(self.requests.items()):
+            lines.append(f'http_requests_total{{method="{method}",route="{_escape(route)}",status="{status_code}"}} {count}')
+
+        lines += ["# HELP http_request_db_statements_total SQL statements executed while serving a route",
+                  "# TYPE http_request_db_statements_total counter"]
+        for (method, route), count in sorted(self.db_statements.items()):
+            lines.append(f'http_request_db_statements_total{{method="{method}",route="{_escape(route)}"}} {count}')
+
+        lines += ["# HELP http_request_db_seconds_total Time spent in SQL while serving a route",
+                  "# TYPE http_request_db_seconds_total counter"]
+        for (method, route), seconds in sorted(self.db_seconds.items()):
+            lines.append(f'http_request_db_seconds_total{{method="{method}",route="{_escape(route)}"}} {seconds}')
+
+        lines += ["# TYPE db_statements_total counter", f"db_statements_total {self.statements_total}",
+                  "# TYPE db_seconds_total counter", f"db_seconds_total {self.db_seconds_total}"]
+
+        for section, values in (gauges or {}).items():
+            if not isinstance(values, dict):
+                continue
+            for name, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = f"api_{section}_{name}"
+                lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def instrument_engine(engine, metrics: "RequestMetrics"):
+    """Подписывает метрики на выполнение SQL движком (время до и после курсора)"""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        metrics.record_statement(statement, time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        # Ошибочный запрос не доходит до after_cursor_execute
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            metrics.record_statement(context.statement or "", time.perf_counter() - started.pop())
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,176 @@
+"""
+Файл содержит версионированные миграции схемы. Примененные версии
+хранятся в таблице schema_migrations, поэтому повторный запуск
+выполняет только новые шаги. В многопроцессном режиме миграции
+запускает app.launcher один раз до старта воркеров.
+"""
+
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, delete, inspect, select, text
+from .database import Base
+from .models import RefreshToken, Comment, ItemValueSummary, ImportJob, IdempotencyKey
+from . import aggregates, indexes, search
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки PostgreSQL: миграции не выполняются параллельно
+MIGRATION_LOCK_ID = 72_310_001
+
+# Служебная таблица в отдельных метаданных, вне Base.metadata
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+async def _drop_legacy_refresh_tokens(conn):
+    """Удаляет таблицу refresh_tokens старого формата (токены в открытом виде, столбец token).
+
+    Перенести токены нельзя: хранится только SHA-256, а исходные значения
+    в новой схеме не нужны. Пользователи входят заново.
+    """
+    def drop(sync_conn):
+        inspector = inspect(sync_conn)
+        if "refresh_tokens" not in inspector.get_table_names():
+            return
+        columns = {column["name"] for column in inspector.get_columns("refresh_tokens")}
+        if "token" in columns and "token_hash" not in columns:
+            RefreshToken.__table__.drop(sync_conn)
+            logger.warning("Dropped legacy refresh_tokens table, issued refresh tokens are revoked")
+
+    await conn.run_sync(drop)
+
+
+async def _create_schema(conn):
+    """Таблицы моделей (существующие таблицы не изменяются)"""
+    await conn.run_sync(Base.metadata.create_all)
+
+
+async def _create_value_summary(conn):
+    """Сводка значений test_items с триггерами и начальным заполнением"""
+    await conn.run_sync(ItemValueSummary.__table__.create, checkfirst=True)
+    triggers = aggregates.SUMMARY_TRIGGERS.get(conn.dialect.name)
+    if triggers is None:
+        logger.warning("Value summary triggers are not available for %s", conn.dialect.name)
+        return
+    for statement in triggers:
+        await conn.execute(text(statement))
+    await conn.execute(delete(ItemValueSummary))
+    await conn.execute(text(aggregates.SUMMARY_BACKFILL))
+
+
+async def _create_import_jobs(conn):
+    """Таблица заданий фонового импорта (ранее задания жили в памяти процесса)"""
+    await conn.run_sync(ImportJob.__table__.create, checkfirst=True)
+
+
+# Внешние ключи, получившие ON DELETE CASCADE после создания таблиц: (модель, столбец)
+CASCADE_FOREIGN_KEYS = [
+    (RefreshToken, "user_id"),
+    (Comment, "item_id"),
+]
+
+
+async def _cascade_foreign_keys(conn):
+    """Добавляет ON DELETE CASCADE в существующие внешние ключи.
+
+    create_all не меняет уже созданные таблицы, поэтому в базах, созданных
+    до появления каскадов, ограничения пересоздаются. PostgreSQL меняет
+    ограничение через ALTER TABLE; SQLite этого не умеет, и таблица
+    пересоздается с копированием строк.
+    """
+    def find_stale(sync_conn):
+        inspector = inspect(sync_conn)
+        tables = set(inspector.get_table_names())
+        stale = []
+        for model, column in CASCADE_FOREIGN_KEYS:
+            table = model.__table__
+            if table.name not in tables:
+                continue
+            existing = [fk for fk in inspector.get_foreign_keys(table.name) if fk["constrained_columns"] == [column]]
+            if not existing or (existing[0].get("options") or {}).get("ondelete", "").upper() != "CASCADE":
+                stale.append((table, column, existing[0]["name"] if existing else None))
+        return stale
+
+    for table, column, constraint in await conn.run_sync(find_stale):
+        fk = next(iter(table.c[column].foreign_keys))
+        target = fk.column
+        # Строки без родителя не дали бы создать ограничение
+        orphans = await conn.execute(text(
+            f"DELETE FROM {table.name} WHERE {column} IS NOT NULL "
+            f"AND {column} NOT IN (SELECT {target.name} FROM {target.table.name})"
+        ))
+        if orphans.rowcount:
+            logger.warning("Deleted %d orphan rows from %s", orphans.rowcount, table.name)
+        if conn.dialect.name == "postgresql":
+            name = constraint or f"{table.name}_{column}_fkey"
+            if constraint:
+                await conn.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT "{constraint}"'))
+            await conn.execute(text(
+                f'ALTER TABLE {table.name} ADD CONSTRAINT "{name}" FOREIGN KEY ({column}) '
+                f"REFERENCES {target.table.name} ({target.name}) ON DELETE CASCADE"
+            ))
+        else:
+            await _rebuild_table(conn, table)
+        logger.info("Foreign key %s.%s now cascades on delete", table.name, column)
+
+
+async def _rebuild_table(conn, table):
+    """Пересоздает таблицу по модели, сохраняя строки (для СУБД без ALTER CONSTRAINT)"""
+    def existing_columns(sync_conn):
+        return {column["name"] for column in inspect(sync_conn).get_columns(table.name)}
+
+    existing = await conn.run_sync(existing_columns)
+    columns = ", ".join(column.name for column in table.columns if column.name in existing)
+    backup = f"{table.name}_rebuild"
+    await conn.execute(text(f"CREATE TEMPORARY TABLE {backup} AS SELECT {columns} FROM {table.name}"))
+    await conn.run_sync(table.drop)
+    await conn.run_sync(table.create)
+    await conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {backup}"))
+    await conn.execute(text(f"DROP TABLE {backup}"))
+
+
+async def _create_idempotency_keys(conn):
+    """Таблица ключей идемпотентности (ранее они хранились в кэше ответов и вытеснялись LRU)"""
+    await conn.run_sync(IdempotencyKey.__table__.create, checkfirst=True)
+
+
+# Миграции по возрастанию версии: (версия, описание, функция)
+MIGRATIONS = [
+    (1, "drop legacy plaintext refresh_tokens", _drop_legacy_refresh_tokens),
+    (2, "create tables and indexes", _create_schema),
+    (3, "item value summary maintained by triggers", _create_value_summary),
+    (4, "import jobs table", _create_import_jobs),
+    (5, "ON DELETE CASCADE for refresh_tokens.user_id and comments.item_id", _cascade_foreign_keys),
+    (6, "idempotency keys table", _create_idempotency_keys),
+]
+
+
+async def run_migrations(engine) -> list[int]:
+    """Применяет недостающие миграции в одной транзакции и возвращает их версии"""
+    started = time.perf_counter()
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        await conn.run_sync(schema_migrations.create, checkfirst=True)
+        applied = set((await conn.execute(select(schema_migrations.c.version))).scalars())
+        pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+        for version, description, migrate in pending:
+            await migrate(conn)
+            await conn.execute(schema_migrations.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+            logger.info("Applied migration %d: %s", version, description)
+        # Индексы сверяются при каждом запуске: новые индексы моделей не требуют отдельной миграции
+        await conn.run_sync(indexes.ensure_indexes)
+        await search.ensure_search_index(conn)
+        await conn.run_sync(indexes.ensure_upsert_index)
+        await conn.run_sync(indexes.report_missing_indexes)
+    logger.info("Schema ready in %.1f ms, %d migrations applied",
+                (time.perf_counter() - started) * 1000, len(pending))
+    return [version for version, _, _ in pending]
@@ -3,7 +3,8 @@
 для базы данных с использованием SQLAlchemy.
 """
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index, JSON, Text, LargeBinary, UniqueConstraint
+from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
 
@@ -21,9 +22,9 @@ class RefreshToken(Base):
     __tablename__ = "refresh_tokens"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    token = Column(String(255), unique=True, nullable=False)
-    expires_at = Column(DateTime, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    token_hash = Column(String(64), unique=True, nullable=False)  # SHA-256 от токена
+    expires_at = Column(DateTime, nullable=False, index=True)
 
 class TestTable(Base):
     """Модель тестовых данных"""
@@ -34,12 +35,94 @@ class TestTable(Base):
     description = Column(String(255))
     value = Column(Integer, default=0)
 
+    # Загружается явно (crud.get_test_items_with_comments), ленивая загрузка запрещена
+    comments = relationship("Comment", back_populates="item", lazy="raise",
+                            order_by="(Comment.created_at, Comment.id)", passive_deletes=True)
+
+    __table_args__ = (
+        # Диапазонные фильтры value_min/value_max с сортировкой по id
+        Index("ix_test_items_value_id", "value", "id"),
+    )
+
 class Comment(Base):
     """Модель комментария"""
     __tablename__ = "comments"
 
     id = Column(Integer, primary_key=True, index=True)
-    item_id = Column(Integer, ForeignKey("test_items.id"), nullable=False)
+    item_id = Column(Integer, ForeignKey("test_items.id", ondelete="CASCADE"), nullable=False)
     author = Column(String(50), nullable=False)
     content = Column(String(500), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    item = relationship("TestTable", back_populates="comments", lazy="raise")
+
+    __table_args__ = (
+        # Комментарии элемента в порядке создания
+        Index("ix_comments_item_id_created_at", "item_id", "created_at"),
+    )
+
+class ItemValueSummary(Base):
+    """Сводка test_items.value: число элементов с каждым значением.
+
+    Поддерживается триггерами БД (см. aggregates.SUMMARY_TRIGGERS).
+    """
+    __tablename__ = "item_value_summary"
+
+    value = Column(Integer, primary_key=True)
+    item_count = Column(Integer, nullable=False, default=0)
+
+class ImportJob(Base):
+    """Задание фонового импорта и его прогресс.
+
+    Хранится в БД, чтобы состояние было видно любому воркеру и
+    переживало перезапуск процесса.
+    """
+    __tablename__ = "import_jobs"
+
+    id = Column(String(32), primary_key=True)
+    file_format = Column(String(20), nullable=False)
+    path = Column(String(500), nullable=False)
+    owner = Column(String(50), nullable=False, index=True)
+    status = Column(String(20), nullable=False, default="queued")
+    rows_processed = Column(Integer, nullable=False, default=0)
+    rows_inserted = Column(Integer, nullable=False, default=0)
+    rows_rejected = Column(Integer, nullable=False, default=0)
+    errors = Column(JSON, nullable=False, default=list)
+    error = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        # Выбор следующего задания из очереди
+        Index("ix_import_jobs_status_created_at", "status", "created_at"),
+    )
+
+    @property
+    def throughput(self) -> float:
+        """Обработанных строк в секунду"""
+        if not self.started_at:
+            return 0.0
+        elapsed = ((self.finished_at or datetime.utcnow()) - self.started_at).total_seconds()
+        return round(self.rows_processed / elapsed, 2) if elapsed > 0 else 0.0
+
+
+class IdempotencyKey(Base):
+    """Ключ Idempotency-Key пользователя и сохраненный ответ.
+
+    Строка без status_code — резерв выполняющегося запроса.
+    """
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    owner = Column(String(50), nullable=False)
+    key_hash = Column(String(64), nullable=False)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(Integer)
+    body = Column(LargeBinary)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("owner", "key_hash", name="ux_idempotency_keys_owner_key"),
+    )
@@ -0,0 +1,83 @@
+"""
+Файл содержит функции keyset-пагинации: кодирование и разбор
+непрозрачных курсоров следующей страницы.
+"""
+
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, Response, status
+
+# Заголовок ответа с курсором следующей страницы
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(**key) -> str:
+    """Кодирует ключ последней строки страницы в курсор"""
+    raw = json.dumps(key, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Декодирует курсор, полученный от клиента"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        key = None
+    if not isinstance(key, dict):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return key
+
+
+def cursor_id(cursor: str):
+    """Возвращает id последней строки из курсора или None, если курсора нет"""
+    if cursor is None:
+        return None
+    last_id = decode_cursor(cursor).get("id")
+    if not isinstance(last_id, int):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return last_id
+
+
+def cursor_created_at(cursor: str):
+    """Возвращает ключ (created_at, id) последней строки из курсора или None"""
+    if cursor is None:
+        return None
+    key = decode_cursor(cursor)
+    try:
+        created_at = datetime.fromisoformat(key.get("created_at"))
+    except (TypeError, ValueError):
+        created_at = None
+    if created_at is None or not isinstance(key.get("id"), int):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return created_at, key["id"]
+
+
+def _id_key(row) -> dict:
+    return {"id": row.id}
+
+
+def created_at_key(row) -> dict:
+    """Ключ курсора для списков, упорядоченных по (created_at, id)"""
+    return {"created_at": row.created_at.isoformat(), "id": row.id}
+
+
+def next_cursor_headers(rows: list, limit: int, key=_id_key) -> dict:
+    """Заголовок с курсором следующей страницы, если страница заполнена целиком"""
+    if rows and len(rows) >= limit:
+        return {NEXT_CURSOR_HEADER: encode_cursor(**key(rows[-1]))}
+    return {}
+
+
+def set_next_cursor(response: Response, rows: list, limit: int, key=_id_key):
+    """Добавляет курсор следующей страницы в ответ"""
+    response.headers.update(next_cursor_headers(rows, limit, key))
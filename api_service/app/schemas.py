@@ -65,6 +65,33 @@ class TestItemResponse(TestItemBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class UploadSummary(BaseModel):
+    """Схема ответа потоковой загрузки файла"""
+    rows_inserted: int
+    chunks: int
+
+class ImportRowError(BaseModel):
+    """Ошибка проверки строки импортируемого файла"""
+    row: int
+    errors: list[str]
+
+class ImportJobResponse(BaseModel):
+    """Схема ответа с состоянием задания импорта"""
+    id: str
+    status: str
+    file_format: str
+    rows_processed: int
+    rows_inserted: int
+    rows_rejected: int
+    errors: list[ImportRowError]
+    throughput: float
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
 class CommentBase(BaseModel):
     """Базовая схема комментария"""
     content: str = Field(..., min_length=1, max_length=500)
@@ -80,4 +107,25 @@ class CommentResponse(CommentBase):
     author: str
     created_at: datetime
 
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+class TestItemWithComments(TestItemResponse):
+    """Схема ответа с элементом и страницей его комментариев"""
+    comments: list[CommentResponse]
+    has_more_comments: bool = False
+
+class HistogramBucket(BaseModel):
+    """Корзина гистограммы: значения в [lower, upper)"""
+    lower: float
+    upper: float
+    count: int
+
+class ItemValueStats(BaseModel):
+    """Статистика value тестовых элементов (группа — префикс названия)"""
+    group: Optional[str] = None
+    count: int
+    min: int
+    max: int
+    mean: float
+    percentiles: dict[str, float]
+    histogram: list[HistogramBucket]
@@ -0,0 +1,79 @@
+"""
+Файл содержит поиск элементов по названию: триграммный GIN-индекс pg_trgm
+на PostgreSQL и встроенную реализацию функции similarity() для SQLite,
+чтобы нечеткий поиск и ранжирование работали и в тестовых установках.
+"""
+
+import re
+from sqlalchemy import event, func, text
+from .models import TestTable
+
+# Режимы поиска по названию
+SEARCH_MODES = ("substring", "fuzzy")
+
+# Шаблон проверки параметра search_mode в маршрутах
+SEARCH_MODE_PATTERN = "^(" + "|".join(SEARCH_MODES) + ")$"
+
+# Порог похожести, совпадает со значением pg_trgm.similarity_threshold по умолчанию
+SIMILARITY_THRESHOLD = 0.3
+
+TRGM_INDEX_NAME = "ix_test_items_name_trgm"
+
+
+def trigrams(value: str) -> set:
+    """Разбивает строку на триграммы по правилам pg_trgm"""
+    result = set()
+    for word in re.findall(r"\w+", value.lower()):
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def similarity(left: str, right: str):
+    """Доля общих триграмм двух строк (аналог similarity() из pg_trgm)"""
+    if left is None or right is None:
+        return None
+    left_trigrams, right_trigrams = trigrams(left), trigrams(right)
+    if not left_trigrams or not right_trigrams:
+        return 0.0
+    return len(left_trigrams & right_trigrams) / len(left_trigrams | right_trigrams)
+
+
+def register_sqlite_functions(engine):
+    """Регистрирует similarity() в каждом новом подключении SQLite"""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("similarity", 2, similarity, deterministic=True)
+
+
+async def ensure_search_index(conn):
+    """Создает расширение pg_trgm и GIN-индекс по названию (только PostgreSQL)"""
+    if conn.dialect.name != "postgresql":
+        return
+    await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    await conn.execute(text(
+        f"CREATE INDEX IF NOT EXISTS {TRGM_INDEX_NAME} "
+        f"ON {TestTable.__tablename__} USING gin (name gin_trgm_ops)"
+    ))
+
+
+def apply_name_search(query, name: str, mode: str, rank: bool, dialect_name: str):
+    """Добавляет к запросу фильтр по названию и, при необходимости, ранжирование.
+
+    Подстрочный поиск (ILIKE '%...%') и нечеткий (оператор %) на PostgreSQL
+    обслуживаются одним GIN-индексом pg_trgm.
+    """
+    score = func.similarity(TestTable.name, name)
+    if mode == "fuzzy":
+        if dialect_name == "postgresql":
+            query = query.filter(TestTable.name.op("%")(name))
+        else:
+            query = query.filter(score >= SIMILARITY_THRESHOLD)
+    else:
+        query = query.filter(TestTable.name.ilike(f"%{name}%"))
+    if rank:
+        query = query.order_by(None).order_by(score.desc(), TestTable.id)
+    return query
@@ -0,0 +1,50 @@
+"""
+Файл содержит потоковую отдачу списков в JSON: строки читаются из БД
+серверным курсором (yield_per) и кодируются пакетами по мере получения,
+поэтому большой limit не требует держать весь ответ в памяти.
+"""
+
+import json
+from datetime import date, datetime
+from pydantic import BaseModel
+from .config import settings
+from .database import AsyncSessionLocal
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него используется стандартный json
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """Кодирует значение в JSON быстрым кодировщиком, если он установлен"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=_default).encode()
+
+
+async def json_array(build_query, schema: type[BaseModel], bind, batch_size: int = None):
+    """Асинхронно отдает JSON-массив строк запроса по частям.
+
+    build_query(db) строит запрос в собственной сессии генератора на движке
+    bind (database.request_bind): сессия из зависимости get_db закрывается
+    до начала отдачи тела ответа.
+    Поля строк берутся по схеме ответа без создания pydantic-объектов.
+    """
+    fields = list(schema.model_fields)
+    batch_size = batch_size or settings.STREAM_BATCH_ROWS
+    async with AsyncSessionLocal(bind=bind) as db:
+        query = build_query(db).execution_options(yield_per=batch_size)
+        result = await db.stream_scalars(query)
+        separator = b"["
+        async for batch in result.partitions():
+            rows = [dumps({field: getattr(row, field) for field in fields}) for row in batch]
+            yield separator + b",".join(rows)
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
@@ -0,0 +1,56 @@
+"""
+Файл содержит фоновую задачу, которая периодически удаляет
+истекшие refresh-токены и ключи идемпотентности небольшими
+пакетами, чтобы таблицы не росли со временем работы сервиса.
+"""
+
+import asyncio
+import logging
+from . import crud
+from .config import settings
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+async def sweep_expired_refresh_tokens(batch_size: int = None) -> int:
+    """Удаляет все истекшие токены пакетами, каждый пакет — отдельная транзакция"""
+    batch_size = batch_size or settings.REFRESH_TOKEN_SWEEP_BATCH
+    total = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            deleted = await crud.delete_expired_refresh_tokens(db, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+
+async def sweep_expired_idempotency_keys(batch_size: int = None) -> int:
+    """Удаляет истекшие ключи идемпотентности пакетами"""
+    batch_size = batch_size or settings.REFRESH_TOKEN_SWEEP_BATCH
+    total = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            deleted = await crud.delete_expired_idempotency_keys(db, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+
+async def run_refresh_token_sweeper(interval: int = None):
+    """Бесконечный цикл очистки с заданным интервалом (в секундах)"""
+    interval = interval or settings.REFRESH_TOKEN_SWEEP_INTERVAL
+    while True:
+        try:
+            deleted = await sweep_expired_refresh_tokens()
+            if deleted:
+                logger.info("Removed %d expired refresh tokens", deleted)
+        except Exception:
+            logger.exception("Refresh token sweep failed")
+        try:
+            deleted = await sweep_expired_idempotency_keys()
+            if deleted:
+                logger.info("Removed %d expired idempotency keys", deleted)
+        except Exception:
+            logger.exception("Idempotency key sweep failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,120 @@
+"""
+Файл содержит поколоночную проверку табличных загрузок. Ограничения
+берутся из schemas.TestItemBase и проверяются операциями pandas над
+целыми столбцами, а не созданием pydantic-объекта на каждую строку.
+Ошибки собираются по всем строкам, а не только по первой.
+"""
+
+import numpy as np
+import pandas as pd
+from . import schemas
+
+# Сколько строк с подробными сообщениями включать в отчет
+MAX_REPORTED_ERRORS = 100
+
+
+def _constraint(field_name: str, attribute: str):
+    """Значение ограничения поля схемы (max_length, ge), если оно задано"""
+    for meta in schemas.TestItemBase.model_fields[field_name].metadata:
+        if getattr(meta, attribute, None) is not None:
+            return getattr(meta, attribute)
+    return None
+
+
+NAME_MAX_LENGTH = _constraint("name", "max_length")
+DESCRIPTION_MAX_LENGTH = _constraint("description", "max_length")
+VALUE_MIN = _constraint("value", "ge")
+VALUE_DEFAULT = schemas.TestItemBase.model_fields["value"].default
+
+
+class TableValidationError(Exception):
+    """Файл содержит строки, не прошедшие проверку"""
+
+    def __init__(self, report: "ValidationReport"):
+        super().__init__(f"{report.rows_rejected} invalid rows")
+        self.report = report
+
+
+def _column(frame: pd.DataFrame, name: str) -> pd.Series:
+    if name in frame:
+        return frame[name]
+    return pd.Series(None, index=frame.index, dtype=object)
+
+
+def _string_lengths(column: pd.Series) -> pd.Series:
+    """Длины строковых значений; NaN для пропусков и значений другого типа"""
+    if column.dtype == object or pd.api.types.is_string_dtype(column):
+        return column.str.len()
+    return pd.Series(np.nan, index=column.index)
+
+
+class ValidationReport:
+    """Накопительный отчет о проверке файла по порциям"""
+
+    def __init__(self, keep_row_indices: bool = True):
+        self.keep_row_indices = keep_row_indices
+        self.rows_checked = 0
+        self.rows_rejected = 0
+        self.invalid_rows = []
+        self.errors = []
+
+    @property
+    def failed(self) -> bool:
+        return self.rows_rejected > 0
+
+    def _add(self, messages: dict):
+        for row in sorted(messages):
+            if self.keep_row_indices:
+                self.invalid_rows.append(row)
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({"row": row, "errors": messages[row]})
+        self.rows_rejected += len(messages)
+
+    def check(self, frame: pd.DataFrame) -> list[dict]:
+        """Проверяет порцию и возвращает корректные строки, готовые к вставке"""
+        frame = frame.reset_index(drop=True)
+        name = _column(frame, "name")
+        description = _column(frame, "description")
+        raw_value = _column(frame, "value")
+
+        name_lengths = _string_lengths(name)
+        description_lengths = _string_lengths(description)
+        value = pd.to_numeric(raw_value, errors="coerce")
+        # Значение по умолчанию — только для файла без столбца value;
+        # пустая ячейка, как и value=None в схеме, не является целым числом
+        if "value" in frame:
+            value_not_int = value.isna() | (value % 1 != 0)
+        else:
+            value = pd.Series(VALUE_DEFAULT, index=frame.index)
+            value_not_int = pd.Series(False, index=frame.index)
+
+        checks = [
+            (name.isna(), "name: Field required"),
+            (name.notna() & name_lengths.isna(), "name: Input should be a valid string"),
+            (name_lengths > NAME_MAX_LENGTH, f"name: String should have at most {NAME_MAX_LENGTH} characters"),
+            (description.notna() & description_lengths.isna(), "description: Input should be a valid string"),
+            (description_lengths > DESCRIPTION_MAX_LENGTH,
+             f"description: String should have at most {DESCRIPTION_MAX_LENGTH} characters"),
+            (value_not_int, "value: Input should be a valid integer"),
+            (~value_not_int & (value < VALUE_MIN),
+             f"value: Input should be greater than or equal to {VALUE_MIN}"),
+        ]
+
+        invalid = np.zeros(len(frame), dtype=bool)
+        messages = {}
+        for mask, message in checks:
+            mask = mask.to_numpy(dtype=bool)
+            invalid |= mask
+            for position in np.flatnonzero(mask):
+                messages.setdefault(self.rows_checked + int(position), []).append(message)
+        self._add(messages)
+        self.rows_checked += len(frame)
+
+        valid = ~invalid
+        result = pd.DataFrame({
+            "name": name[valid],
+            "description": description[valid],
+            "value": value[valid].astype("int64"),
+        })
+        result = result.astype(object).where(result.notna(), None)
+        return result.to_dict(orient="records")
@@ -0,0 +1,4 @@
+"""
+Нагрузочные замеры api_service: сценарии запросов и запуск
+с отчетом о задержках (p50/p95/p99) и пропускной способности в JSON.
+"""
@@ -0,0 +1,127 @@
+"""
+Файл содержит сценарии нагрузочного теста. Сценарий — асинхронная
+функция (client, ctx, worker, i), выполняющая один запрос и
+возвращающая ответ; подготовка данных выполняется в prepare().
+"""
+
+import io
+import random
+
+PASSWORD = "bench-password"
+
+
+def _auth(ctx) -> dict:
+    return {"Authorization": f"Bearer {ctx['access_token']}"}
+
+
+async def prepare(client, ctx):
+    """Создает пользователей, элементы и комментарии, общие для всех сценариев"""
+    users = [f"bench_{ctx['run_id']}_{n}" for n in range(ctx["concurrency"])]
+    tokens = []
+    for username in users:
+        response = await client.post("/register", json={"username": username, "password": PASSWORD})
+        response.raise_for_status()
+        tokens.append(response.json())
+    ctx["users"] = users
+    ctx["access_token"] = tokens[0]["access_token"]
+    ctx["refresh_tokens"] = [token["refresh_token"] for token in tokens]
+
+    # Элементы для сценария удаления создаются сверх seed_items: каждый удаляется один раз
+    rows = [
+        {"name": f"bench item {n}", "description": "bench", "value": n % 1000}
+        for n in range(ctx["seed_items"] + ctx["delete_items"])
+    ]
+    item_ids = []
+    for offset in range(0, len(rows), 1000):
+        response = await client.post("/batch-items/", json=rows[offset:offset + 1000], headers=_auth(ctx))
+        response.raise_for_status()
+        item_ids.extend(item["id"] for item in response.json())
+    ctx["item_ids"] = item_ids
+    ctx["readable_ids"] = item_ids[:ctx["seed_items"]]
+    ctx["deletable_ids"] = item_ids[ctx["seed_items"]:]
+
+    for item_id in ctx["readable_ids"][:ctx["comment_items"]]:
+        for n in range(ctx["comments_per_item"]):
+            await client.post(f"/items/{item_id}/comments", json={"content": f"seed {n}"}, headers=_auth(ctx))
+
+
+async def login(client, ctx, worker, i):
+    return await client.post("/login", json={"username": ctx["users"][worker], "password": PASSWORD})
+
+
+async def refresh(client, ctx, worker, i):
+    # У каждого исполнителя своя цепочка ротации refresh-токенов
+    response = await client.post("/refresh", json={"refresh_token": ctx["refresh_tokens"][worker]})
+    if response.status_code == 200:
+        ctx["refresh_tokens"][worker] = response.json()["refresh_token"]
+    return response
+
+
+async def item_create(client, ctx, worker, i):
+    payload = {"name": f"created {worker}-{i}", "description": "bench", "value": i % 1000}
+    return await client.post("/items/", json=payload, headers=_auth(ctx))
+
+
+async def item_read(client, ctx, worker, i):
+    return await client.get(f"/items/{random.choice(ctx['readable_ids'])}", headers=_auth(ctx))
+
+
+async def item_update(client, ctx, worker, i):
+    item_id = random.choice(ctx["readable_ids"])
+    return await client.patch(f"/items/{item_id}", json={"value": i % 1000}, headers=_auth(ctx))
+
+
+async def item_delete(client, ctx, worker, i):
+    item_id = ctx["deletable_ids"].pop()
+    return await client.delete(f"/items/{item_id}", headers=_auth(ctx))
+
+
+async def list_filtered(client, ctx, worker, i):
+    low = random.randrange(0, 900)
+    params = {"value_min": low, "value_max": low + 100, "name": "item", "limit": 50}
+    return await client.get("/items/", params=params, headers=_auth(ctx))
+
+
+async def batch_ingest(client, ctx, worker, i):
+    rows = [{"name": f"batch {worker}-{i}-{n}", "value": n} for n in range(ctx["batch_size"])]
+    return await client.post("/batch-items/", json=rows, headers=_auth(ctx))
+
+
+async def csv_ingest(client, ctx, worker, i):
+    lines = ["name,description,value"]
+    lines += [f"csv {worker}-{i}-{n},bench,{n}" for n in range(ctx["batch_size"])]
+    files = {"file": ("bench.csv", io.BytesIO("\n".join(lines).encode()), "text/csv")}
+    return await client.post("/upload-csv/", params={"stream": "true"}, files=files, headers=_auth(ctx))
+
+
+async def comment_create(client, ctx, worker, i):
+    item_id = random.choice(ctx["readable_ids"][:ctx["comment_items"]])
+    return await client.post(f"/items/{item_id}/comments", json={"content": f"comment {i}"}, headers=_auth(ctx))
+
+
+async def comment_list(client, ctx, worker, i):
+    item_id = random.choice(ctx["readable_ids"][:ctx["comment_items"]])
+    return await client.get(f"/items/{item_id}/comments", params={"limit": 20}, headers=_auth(ctx))
+
+
+async def comment_fanout(client, ctx, worker, i):
+    # Страница элементов вместе с комментариями (вместо N запросов /comments)
+    return await client.get("/items/", params={"include": "comments", "limit": ctx["comment_items"]},
+                            headers=_auth(ctx))
+
+
+# Сценарии в порядке запуска; item_delete расходует элементы из prepare()
+SCENARIOS = {
+    "login": login,
+    "refresh": refresh,
+    "item_create": item_create,
+    "item_read": item_read,
+    "item_update": item_update,
+    "list_filtered": list_filtered,
+    "batch_ingest": batch_ingest,
+    "csv_ingest": csv_ingest,
+    "comment_create": comment_create,
+    "comment_list": comment_list,
+    "comment_fanout": comment_fanout,
+    "item_delete": item_delete,
+}